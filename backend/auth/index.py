@@ -1,33 +1,627 @@
+import base64
 import json
 import os
 import hashlib
+import hmac
+import math
 import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import jwt
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+DB_PING_INTERVAL = 30
+
+# Соединение переживает вызов и переиспользуется тёплым контейнером
+_db_conn = None
+_db_last_used = 0.0
+DB_STATS = {'connects': 0, 'reuses': 0, 'reconnects': 0}
+
+def ping_connection(conn) -> bool:
+    """Дешёвая проверка живости соединения"""
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        if not conn.autocommit:
+            conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    """Подключение к БД через переменную окружения DATABASE_URL"""
-    dsn = os.environ['DATABASE_URL']
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+    """Соединение с БД: тёплое из прошлого вызова или новое"""
+    global _db_conn
+    
+    conn = _db_conn
+    if conn is not None and not conn.closed:
+        if time.monotonic() - _db_last_used < DB_PING_INTERVAL or ping_connection(conn):
+            DB_STATS['reuses'] += 1
+            return conn
+        DB_STATS['reconnects'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    _db_conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+    DB_STATS['connects'] += 1
+    return _db_conn
+
+def release_db_connection(conn) -> None:
+    """Конец вызова: сбрасываем незавершённую транзакцию, дописываем продления сессий,
+    соединение не закрываем"""
+    global _db_last_used
+    
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        flush_session_extensions(conn)
+        _db_last_used = time.monotonic()
+    except psycopg2.Error:
+        conn.close()
+
+SESSION_CACHE_SIZE = 1024
+SESSION_CACHE_TTL = 60
+SESSION_NEGATIVE_TTL = 10
+
+# token -> (момент записи, сессия или None); порядок ключей = порядок использования
+_session_cache = OrderedDict()
+SESSION_STATS = {'hits': 0, 'misses': 0, 'extended': 0, 'revoked': 0}
+
+def cache_session(token: str, session) -> None:
+    """Запоминает сессию (или её отсутствие) для токена"""
+    _session_cache[token] = (time.monotonic(), session)
+    _session_cache.move_to_end(token)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+
+def cached_session(token: str) -> tuple:
+    """(найдено в кеше, сессия или None) без обращения к БД"""
+    entry = _session_cache.get(token)
+    if entry is None:
+        return False, None
+    
+    stored_at, session = entry
+    ttl = SESSION_CACHE_TTL if session else SESSION_NEGATIVE_TTL
+    if time.monotonic() - stored_at >= ttl or (session and session['expires_at'] <= datetime.now()):
+        del _session_cache[token]
+        return False, None
+    
+    _session_cache.move_to_end(token)
+    return True, session
+
+# Скользящий срок сессии: продление не чаще раза в SESSION_EXTEND_INTERVAL на токен.
+# Момент прошлого продления виден по expires_at (оно всегда равно продлению + SESSION_TTL),
+# продления копятся в памяти и записываются одним UPDATE при освобождении соединения
+SESSION_TTL = timedelta(days=30)
+SESSION_EXTEND_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_EXTEND_INTERVAL', '3600')))
+SESSION_FLUSH_INTERVAL = 30
+SESSION_FLUSH_BATCH = 100
+_pending_extensions = set()
+_pending_since = 0.0
+
+def touch_session(token: str, session) -> None:
+    """Ставит непрозрачную сессию в очередь на продление, если подошёл её срок"""
+    global _pending_since
+    
+    if session is None:
+        return
+    extended = datetime.now() + SESSION_TTL
+    if extended - session['expires_at'] < SESSION_EXTEND_INTERVAL:
+        return
+    
+    # Сессия в кеше — тот же объект: следующие запросы в контейнере её уже не продлевают
+    session['expires_at'] = extended
+    if not _pending_extensions:
+        _pending_since = time.monotonic()
+    _pending_extensions.add(token_digest(token))
+
+def flush_session_extensions(conn) -> None:
+    """Записывает накопленные продления, когда их много или они копятся дольше SESSION_FLUSH_INTERVAL"""
+    if not _pending_extensions:
+        return
+    if len(_pending_extensions) < SESSION_FLUSH_BATCH and time.monotonic() - _pending_since < SESSION_FLUSH_INTERVAL:
+        return
+    
+    token_hashes = list(_pending_extensions)
+    _pending_extensions.clear()
+    with conn.cursor() as cur:
+        cur.execute(
+            """UPDATE user_sessions SET expires_at = NOW() + %s
+               WHERE token_hash = ANY(%s) AND expires_at > NOW()""",
+            (SESSION_TTL, token_hashes)
+        )
+        SESSION_STATS['extended'] += cur.rowcount
+    conn.commit()
+
+# Готовый ответ /me по токену: повторные загрузки SPA обходятся без запроса к БД.
+# Logout и logout_all сбрасывают записи сразу; изменения профиля и роли из других
+# функций, logout и logout_all из других контейнеров видны по users.profile_changed_at
+# и users.session_generation_changed_at, которые опрашиваются не чаще ME_POLL_INTERVAL
+ME_CACHE_SIZE = 1024
+ME_CACHE_TTL = 30
+ME_POLL_INTERVAL = 2
+ME_POLL_OVERLAP = timedelta(seconds=10)
+_me_cache = OrderedDict()
+_me_changes_since = None
+_me_polled_at = 0.0
+ME_STATS = {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidated': 0}
+
+def cache_me(token: str, session: dict, body: str) -> dict:
+    entry = {
+        'stored_at': time.monotonic(),
+        'session': session,
+        'body': body,
+        'etag': 'W/"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+    }
+    _me_cache[token] = entry
+    _me_cache.move_to_end(token)
+    while len(_me_cache) > ME_CACHE_SIZE:
+        _me_cache.popitem(last=False)
+    return entry
+
+def cached_me(token: str):
+    entry = _me_cache.get(token)
+    if entry is None:
+        return None
+    if time.monotonic() - entry['stored_at'] >= ME_CACHE_TTL or entry['session']['expires_at'] <= datetime.now():
+        del _me_cache[token]
+        return None
+    _me_cache.move_to_end(token)
+    return entry
 
-def hash_password(password: str) -> str:
-    """Хеширование пароля с солью (ограничено 255 символами)"""
-    salt = hashlib.sha256(os.urandom(32)).hexdigest()[:32].encode('ascii')
-    pwdhash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 50000)
-    return (salt + pwdhash).hex()[:255]
+def drop_cached_me(user_id: int) -> None:
+    for token, entry in list(_me_cache.items()):
+        if entry['session']['user_id'] == user_id:
+            del _me_cache[token]
+            ME_STATS['invalidated'] += 1
+
+def me_poll_due() -> bool:
+    return _me_changes_since is None or time.monotonic() - _me_polled_at >= ME_POLL_INTERVAL
+
+def poll_profile_changes(cur) -> None:
+    """Сбрасывает кеш /me пользователей, чей профиль, роль или поколение сессий изменились"""
+    global _me_changes_since, _me_polled_at
+    
+    # Отметка опроса берётся с часов БД: ими же проставлены *_changed_at
+    since = _me_changes_since - ME_POLL_OVERLAP if _me_changes_since is not None and _me_cache else None
+    cur.execute(
+        """
+        SELECT LOCALTIMESTAMP AS polled_at, u.id
+        FROM (SELECT 1) AS one
+        LEFT JOIN users u
+          ON %(since)s::timestamp IS NOT NULL
+         AND (u.profile_changed_at > %(since)s OR u.session_generation_changed_at > %(since)s)
+        """,
+        {'since': since}
+    )
+    for row in cur.fetchall():
+        if row['id'] is not None:
+            drop_cached_me(row['id'])
+    _me_changes_since = row['polled_at']
+    _me_polled_at = time.monotonic()
+
+ACCESS_TOKEN_TTL = 900
+
+# JWT_KEYS='{"kid": "секрет", ...}' держит текущий и предыдущие ключи на время ротации,
+# JWT_ACTIVE_KID выбирает ключ подписи, JWT_SECRET — одиночный ключ с kid "default"
+_jwt_keys = None
+
+def get_jwt_keys() -> dict:
+    """Ключи подписи access-токенов: kid -> секрет"""
+    global _jwt_keys
+    
+    if _jwt_keys is None:
+        keys = json.loads(os.environ.get('JWT_KEYS') or '{}')
+        if os.environ.get('JWT_SECRET'):
+            keys.setdefault('default', os.environ['JWT_SECRET'])
+        _jwt_keys = keys
+    return _jwt_keys
+
+def create_access_token(user_id: int, role: str, generation: int):
+    """Короткоживущий JWT с ролью и поколением сессий для проверки без БД (None, если ключ не настроен)"""
+    kid = os.environ.get('JWT_ACTIVE_KID', 'default')
+    secret = get_jwt_keys().get(kid)
+    if not secret:
+        return None
+    
+    now = datetime.now(timezone.utc)
+    payload = {
+        'user_id': user_id,
+        'role': role,
+        'gen': generation,
+        'iat': now,
+        'exp': now + timedelta(seconds=ACCESS_TOKEN_TTL)
+    }
+    return jwt.encode(payload, secret, algorithm='HS256', headers={'kid': kid})
+
+# Схема хеширования новых паролей и её стоимость: PASSWORD_SCHEME=pbkdf2-sha256|scrypt
+PASSWORD_SCHEME = os.environ.get('PASSWORD_SCHEME', 'pbkdf2-sha256')
+PBKDF2_ITERATIONS = int(os.environ.get('PBKDF2_ITERATIONS', '50000'))
+SCRYPT_N = int(os.environ.get('SCRYPT_N', '16384'))
+SCRYPT_R = int(os.environ.get('SCRYPT_R', '8'))
+SCRYPT_P = int(os.environ.get('SCRYPT_P', '1'))
+
+# Формат до версионирования: hex(32 ascii-символа соли + PBKDF2-SHA256), 50000 итераций
+LEGACY_PBKDF2_ITERATIONS = 50000
+# Обязательные параметры каждой схемы в $схема$параметры$соль$хеш
+PASSWORD_SCHEME_PARAMS = {'pbkdf2-sha256': {'i'}, 'scrypt': {'n', 'r', 'p'}}
+
+def password_params() -> tuple:
+    """Текущая схема хеширования и её параметры"""
+    if PASSWORD_SCHEME == 'scrypt':
+        return 'scrypt', {'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P}
+    return 'pbkdf2-sha256', {'i': PBKDF2_ITERATIONS}
+
+def encode_params(params: dict) -> str:
+    return ','.join(f'{key}={value}' for key, value in params.items())
+
+def b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def b64decode(data: str) -> bytes:
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+def derive_key(scheme: str, params: dict, password: str, salt: bytes) -> bytes:
+    """Ключ из пароля по схеме и параметрам"""
+    if scheme == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p, dklen=32)
+    if scheme == 'pbkdf2-sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, params['i'])
+    raise ValueError(f'Неизвестная схема хеширования: {scheme}')
+
+def hash_password(password: str, scheme: str = None, params: dict = None) -> str:
+    """Хеширование пароля: $схема$параметры$соль$хеш (укладывается в 255 символов)"""
+    if scheme is None:
+        scheme, params = password_params()
+    salt = os.urandom(16)
+    key = derive_key(scheme, params, password, salt)
+    return f'${scheme}${encode_params(params)}${b64encode(salt)}${b64encode(key)}'
+
+def parse_password_hash(stored_password: str) -> tuple:
+    """(схема, параметры, соль, хеш) из сохранённого значения любого формата.
+    
+    ValueError, если формат, схема или её параметры не поддерживаются.
+    """
+    if not stored_password.startswith('$'):
+        return ('pbkdf2-sha256', {'i': LEGACY_PBKDF2_ITERATIONS},
+                bytes.fromhex(stored_password[:64]), bytes.fromhex(stored_password[64:]))
+    
+    _, scheme, encoded_params, salt, key = stored_password.split('$')
+    params = {}
+    for item in encoded_params.split(','):
+        name, value = item.split('=')
+        params[name] = int(value)
+    required = PASSWORD_SCHEME_PARAMS.get(scheme)
+    if required is None or required - params.keys() or any(value < 1 for value in params.values()):
+        raise ValueError(f'Неподдерживаемый хеш пароля: {scheme}${encoded_params}')
+    return scheme, params, b64decode(salt), b64decode(key)
 
 def verify_password(stored_password: str, provided_password: str) -> bool:
     """Проверка пароля"""
-    salt = bytes.fromhex(stored_password[:64])
-    stored_hash = stored_password[64:]
-    pwdhash = hashlib.pbkdf2_hmac('sha256', provided_password.encode('utf-8'), salt, 50000)
-    return pwdhash.hex() == stored_hash
+    if not stored_password:
+        return False
+    scheme, params, salt, key = parse_password_hash(stored_password)
+    return hmac.compare_digest(derive_key(scheme, params, provided_password, salt), key)
+
+def needs_rehash(stored_password: str) -> bool:
+    """Хеш сделан другой схемой или с другой стоимостью, чем настроено сейчас"""
+    scheme, params = password_params()
+    return not stored_password.startswith(f'${scheme}${encode_params(params)}$')
+
+# Ограничение попыток входа: ведро токенов (ёмкость, пополнение в секунду) на email и на IP
+LOGIN_LIMITS = {
+    'email': (5, 1 / 60),
+    'ip': (30, 1 / 2)
+}
+LOGIN_BUCKETS_SIZE = 10000
+
+# Локальные вёдра отсекают явный перебор без БД, общие (таблица login_throttle)
+# держат лимит между тёплыми экземплярами функции
+_login_buckets = OrderedDict()
+THROTTLE_STATS = {'allowed': 0, 'rejected_local': 0, 'rejected_shared': 0}
+
+def get_source_ip(event: dict) -> str:
+    """IP клиента из контекста запроса"""
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    return identity.get('sourceIp', '')
+
+def login_buckets(email: str, source_ip: str) -> list:
+    """Вёдра, из которых списывается попытка входа: (имя, ключ, ёмкость, пополнение)"""
+    buckets = [('email', f'email:{email}', *LOGIN_LIMITS['email'])]
+    if source_ip:
+        buckets.append(('ip', f'ip:{source_ip}', *LOGIN_LIMITS['ip']))
+    return buckets
+
+def take_local_token(key: str, capacity: int, rate: float) -> float:
+    """Списывает токен из локального ведра: 0, если можно, иначе секунды ожидания"""
+    now = time.monotonic()
+    tokens, updated_at = _login_buckets.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    
+    wait = 0 if tokens >= 1 else (1 - tokens) / rate
+    _login_buckets[key] = (tokens - 1 if not wait else tokens, now)
+    _login_buckets.move_to_end(key)
+    while len(_login_buckets) > LOGIN_BUCKETS_SIZE:
+        _login_buckets.popitem(last=False)
+    return wait
+
+def drain_local_bucket(key: str) -> None:
+    """Общее ведро пусто: локальное тоже обнуляем, чтобы не ходить в БД зря"""
+    _login_buckets[key] = (0, time.monotonic())
+
+def throttle_cte(name: str) -> str:
+    """CTE, атомарно пополняющее и списывающее токен общего ведра; строка есть, если можно"""
+    refilled = (f"LEAST(%({name}_capacity)s::real, "
+                f"t.tokens + EXTRACT(EPOCH FROM NOW() - t.updated_at)::real * %({name}_rate)s::real)")
+    return f"""{name} AS (
+                INSERT INTO login_throttle AS t (bucket_key, tokens, updated_at)
+                VALUES (%({name}_key)s, %({name}_capacity)s - 1, NOW())
+                ON CONFLICT (bucket_key) DO UPDATE
+                SET tokens = {refilled} - 1, updated_at = NOW()
+                WHERE {refilled} >= 1
+                RETURNING 1
+            )"""
+
+def login_query(email: str, buckets: list) -> tuple:
+    """Списание из общих вёдер и поиск пользователя — одним запросом: (SQL, параметры)"""
+    params = {'email': email}
+    for name, key, capacity, rate in buckets:
+        params.update({f'{name}_key': key, f'{name}_capacity': capacity, f'{name}_rate': rate})
+    
+    return f"""
+            WITH {', '.join(throttle_cte(name) for name, *_ in buckets)}
+            SELECT {', '.join(f'EXISTS(SELECT 1 FROM {name}) AS {name}_allowed' for name, *_ in buckets)},
+                   u.id, u.username, u.email, u.password_hash, u.is_active,
+                   p.user_role, p.phone, p.is_verified
+            FROM (SELECT 1) AS attempt
+            LEFT JOIN users u ON u.email = %(email)s
+            LEFT JOIN user_profiles p ON u.id = p.user_id
+            """, params
+
+def throttled_response(wait: float) -> dict:
+    return {
+        'statusCode': 429,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'Retry-After',
+            'Retry-After': str(max(1, math.ceil(wait)))
+        },
+        'body': json.dumps({'error': 'Слишком много попыток входа, попробуйте позже'})
+    }
+
+# Фильтр Блума по users.email/users.username для проверки занятости без запроса к БД.
+# Фильтр строится и обновляется в фоновом потоке на отдельном соединении: /check его
+# не ждёт и, пока фильтра нет, проверяет всё по индексам. Раз в BLOOM_REFRESH_INTERVAL
+# догружаются новые пользователи и сменившие email/username (по profile_changed_at);
+# освобождённые значения остаются в фильтре до пересборки раз в BLOOM_REBUILD_INTERVAL,
+# но попадание в фильтр всегда перепроверяется в БД и стоит лишь лишнего запроса
+BLOOM_CAPACITY = int(os.environ.get('BLOOM_CAPACITY', '200000'))
+BLOOM_ERROR_RATE = 0.01
+BLOOM_REFRESH_INTERVAL = 60
+BLOOM_REBUILD_INTERVAL = int(os.environ.get('BLOOM_REBUILD_INTERVAL', '3600'))
+# Новые строки догружаются по id > последнего загруженного, изменённые — по отметке
+# с часов БД; перекрытия ловят транзакции, закоммиченные не в порядке id и отметок
+BLOOM_ID_OVERLAP = 1000
+BLOOM_CHANGES_OVERLAP = timedelta(seconds=10)
+
+class BloomFilter:
+    """Битовый фильтр Блума: «точно нет» или «возможно есть»"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+    
+    def add(self, key: str) -> None:
+        positions = self.positions(key)
+        if not all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+            self.count += 1
+        for pos in positions:
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+    
+    def error_rate(self) -> float:
+        """Расчётная доля ложноположительных ответов при текущем заполнении"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+_bloom = None
+_bloom_max_id = 0
+_bloom_changes_since = None
+_bloom_built_at = 0.0
+_bloom_started_at = None
+_bloom_running = threading.Lock()
+BLOOM_STATS = {'checks': 0, 'filter_free': 0, 'db_checks': 0, 'false_positives': 0,
+               'rebuilds': 0, 'refresh_errors': 0}
+
+def bloom_needs_refresh() -> bool:
+    return _bloom_started_at is None or time.monotonic() - _bloom_started_at >= BLOOM_REFRESH_INTERVAL
+
+def refresh_bloom(conn) -> None:
+    """Пересобирает фильтр или догружает в него новых и изменившихся пользователей"""
+    global _bloom, _bloom_max_id, _bloom_changes_since, _bloom_built_at
+    
+    rebuild = (_bloom is None or _bloom.count > _bloom.capacity
+               or time.monotonic() - _bloom_built_at >= BLOOM_REBUILD_INTERVAL)
+    with conn.cursor() as cur:
+        cur.execute("SELECT LOCALTIMESTAMP AS now")
+        started_at = cur.fetchone()['now']
+        if rebuild:
+            # Два ключа (email и username) на пользователя и двукратный запас на рост:
+            # после массового импорта фильтр не должен начинать переполненным
+            cur.execute("SELECT count(*) AS users FROM users")
+            users = cur.fetchone()['users']
+    conn.commit()
+    
+    if rebuild:
+        capacity = max(BLOOM_CAPACITY, 2 * 2 * users)
+        bloom, max_id = BloomFilter(capacity, BLOOM_ERROR_RATE), 0
+    else:
+        bloom, max_id = _bloom, _bloom_max_id
+    
+    with conn.cursor(name='bloom_refresh') as cur:
+        cur.itersize = 5000
+        if rebuild:
+            cur.execute("SELECT id, email, username FROM users")
+        else:
+            cur.execute(
+                "SELECT id, email, username FROM users WHERE id > %s OR profile_changed_at > %s",
+                (max(0, max_id - BLOOM_ID_OVERLAP), _bloom_changes_since - BLOOM_CHANGES_OVERLAP)
+            )
+        for row in cur:
+            if row['email']:
+                bloom.add(f"e:{row['email']}")
+            bloom.add(f"u:{row['username']}")
+            max_id = max(max_id, row['id'])
+    conn.commit()
+    
+    # Новый фильтр подменяет старый целиком: /check до этого пользуется прежним
+    _bloom, _bloom_max_id, _bloom_changes_since = bloom, max_id, started_at
+    if rebuild:
+        _bloom_built_at = time.monotonic()
+        BLOOM_STATS['rebuilds'] += 1
+
+def refresh_bloom_in_background() -> None:
+    try:
+        conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+        try:
+            refresh_bloom(conn)
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        BLOOM_STATS['refresh_errors'] += 1
+        print(f"Bloom refresh failed: {e}")
+    finally:
+        _bloom_running.release()
+
+def start_bloom_refresh() -> None:
+    """Запускает обновление фильтра в фоне, если подошёл срок и оно ещё не идёт"""
+    global _bloom_started_at
+    
+    if bloom_needs_refresh() and _bloom_running.acquire(blocking=False):
+        _bloom_started_at = time.monotonic()
+        threading.Thread(target=refresh_bloom_in_background, daemon=True).start()
+
+def bloom_metrics() -> dict:
+    return {
+        **BLOOM_STATS,
+        'entries': _bloom.count if _bloom else 0,
+        'estimated_fpr': _bloom.error_rate() if _bloom else None,
+        'observed_fpr': BLOOM_STATS['false_positives'] / BLOOM_STATS['db_checks'] if BLOOM_STATS['db_checks'] else None
+    }
+
+# Очистка сессий: удаление истёкших месячных секций user_sessions и построчное
+# удаление остатков небольшими пачками, каждая в своей короткой транзакции.
+# Так же пачками удаляются вёдра login_throttle, не менявшиеся дольше полного
+# пополнения: они равны полному ведру
+SESSION_PARTITIONS_AHEAD = 3
+REAPER_BATCH_SIZE = int(os.environ.get('REAPER_BATCH_SIZE', '500'))
+REAPER_TIME_BUDGET = float(os.environ.get('REAPER_TIME_BUDGET', '20'))
+REAPER_LOCK_TIMEOUT = '2s'
+THROTTLE_IDLE = timedelta(seconds=max(capacity / refill for capacity, refill in LOGIN_LIMITS.values()))
+
+REAP_SESSIONS_SQL = """
+    DELETE FROM user_sessions
+    WHERE (id, expires_at) IN (
+        SELECT id, expires_at FROM user_sessions
+        WHERE expires_at <= NOW()
+        LIMIT %s
+    )
+"""
+
+REAP_THROTTLE_SQL = """
+    DELETE FROM login_throttle
+    WHERE bucket_key IN (
+        SELECT bucket_key FROM login_throttle
+        WHERE updated_at < NOW() - %s
+        LIMIT %s
+    )
+"""
+
+def is_timer_event(event: dict) -> bool:
+    """Вызов по триггеру-таймеру, а не через HTTP"""
+    messages = event.get('messages') or []
+    return bool(messages) and all(
+        message.get('event_metadata', {}).get('event_type', '').endswith('TimerMessage')
+        for message in messages
+    )
+
+def reap_sessions(conn) -> dict:
+    """Удаляет истёкшие сессии и полные вёдра ограничения входа, возвращает отчёт"""
+    started = time.monotonic()
+    report = {'partitions_dropped': 0, 'rows_deleted': 0, 'throttle_rows_deleted': 0, 'batches': 0}
+    cur = conn.cursor()
+    
+    try:
+        # DROP секции берёт эксклюзивную блокировку родителя: не ждём её дольше lock_timeout
+        try:
+            cur.execute("SET LOCAL lock_timeout = %s", (REAPER_LOCK_TIMEOUT,))
+            cur.execute(
+                "SELECT maintain_user_sessions_partitions(%s) AS dropped",
+                (SESSION_PARTITIONS_AHEAD,)
+            )
+            report['partitions_dropped'] = cur.fetchone()['dropped']
+            conn.commit()
+        except psycopg2.OperationalError as e:
+            conn.rollback()
+            report['partitions_error'] = e.pgcode
+        
+        while time.monotonic() - started < REAPER_TIME_BUDGET:
+            cur.execute(REAP_SESSIONS_SQL, (REAPER_BATCH_SIZE,))
+            deleted = cur.rowcount
+            conn.commit()
+            report['rows_deleted'] += deleted
+            report['batches'] += 1
+            if deleted < REAPER_BATCH_SIZE:
+                break
+        
+        while time.monotonic() - started < REAPER_TIME_BUDGET:
+            cur.execute(REAP_THROTTLE_SQL, (THROTTLE_IDLE, REAPER_BATCH_SIZE))
+            deleted = cur.rowcount
+            conn.commit()
+            report['throttle_rows_deleted'] += deleted
+            report['batches'] += 1
+            if deleted < REAPER_BATCH_SIZE:
+                break
+    finally:
+        cur.close()
+    
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+def token_digest(token: str) -> bytes:
+    """В user_sessions хранится SHA-256 токена, а не сам токен"""
+    return hashlib.sha256(token.encode('utf-8')).digest()
 
 def generate_token() -> str:
     """Генерация токена для сессии"""
     return secrets.token_urlsafe(32)
 
+def metrics_allowed(event: dict) -> bool:
+    """Счётчики отдаются только с заголовком X-Metrics-Token, равным секрету METRICS_TOKEN"""
+    expected = os.environ.get('METRICS_TOKEN', '')
+    provided = next((value or '' for key, value in (event.get('headers') or {}).items()
+                     if key.lower() == 'x-metrics-token'), '')
+    return bool(expected) and hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
+
 def handler(event: dict, context) -> dict:
     """
     API для регистрации и авторизации пользователей SPARCOM.
@@ -35,8 +629,20 @@ def handler(event: dict, context) -> dict:
     POST /register - регистрация нового пользователя
     POST /login - вход в систему
     POST /logout - выход из системы
+    POST /logout_all - выход на всех устройствах
     GET /me - получить данные текущего пользователя
+    GET /check - свободны ли email и username
+    GET /metrics - счётчики соединений с БД (заголовок X-Metrics-Token)
+    
+    Вызов по триггеру-таймеру очищает истёкшие сессии.
     """
+    if is_timer_event(event):
+        conn = get_db_connection()
+        try:
+            return {'statusCode': 200, 'body': json.dumps(reap_sessions(conn))}
+        finally:
+            release_db_connection(conn)
+    
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -45,7 +651,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization'
+                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization, If-None-Match'
             },
             'body': ''
         }
@@ -60,13 +666,35 @@ def handler(event: dict, context) -> dict:
             return handle_login(event)
         elif method == 'POST' and action == 'logout':
             return handle_logout(event)
+        elif method == 'POST' and action == 'logout_all':
+            return handle_logout_all(event)
         elif method == 'GET' and action == 'me':
             return handle_get_user(event)
+        elif method == 'GET' and action == 'check':
+            return handle_check(event)
+        elif method == 'GET' and action == 'metrics':
+            if not metrics_allowed(event):
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Доступ запрещён'})
+                }
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'db': DB_STATS,
+                    'sessions': SESSION_STATS,
+                    'me_cache': ME_STATS,
+                    'login_throttle': THROTTLE_STATS,
+                    'availability_filter': bloom_metrics()
+                })
+            }
         else:
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Action not found. Use ?action=register|login|logout|me'})
+                'body': json.dumps({'error': 'Action not found. Use ?action=register|login|logout|logout_all|me|check'})
             }
     except Exception as e:
         return {
@@ -75,6 +703,29 @@ def handler(event: dict, context) -> dict:
             'body': json.dumps({'error': str(e)})
         }
 
+# Пользователь и профиль — одним выражением; при конфликте уникальности не
+# вставляется ничего, а EXISTS по снимку до вставки показывают, что занято
+REGISTER_SQL = """
+    WITH new_user AS (
+        INSERT INTO users (username, email, password_hash)
+        VALUES (%(username)s, %(email)s, %(password_hash)s)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    ), profile AS (
+        INSERT INTO user_profiles (user_id, user_role, phone)
+        SELECT id, %(role)s, %(phone)s FROM new_user
+        RETURNING user_id
+    )
+    SELECT (SELECT user_id FROM profile) AS user_id,
+           EXISTS(SELECT 1 FROM users WHERE email = %(email)s) AS email_taken,
+           EXISTS(SELECT 1 FROM users WHERE username = %(username)s) AS username_taken
+"""
+
+TAKEN_SQL = """
+    SELECT EXISTS(SELECT 1 FROM users WHERE email = %(email)s) AS email_taken,
+           EXISTS(SELECT 1 FROM users WHERE username = %(username)s) AS username_taken
+"""
+
 def handle_register(event: dict) -> dict:
     """Регистрация нового пользователя"""
     data = json.loads(event.get('body', '{}'))
@@ -92,32 +743,42 @@ def handle_register(event: dict) -> dict:
             'body': json.dumps({'error': 'Username, email и password обязательны'})
         }
     
+    password_hash = hash_password(password)
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT id FROM users WHERE email = %s OR username = %s", (email, username))
-        if cur.fetchone():
+        cur.execute(
+            REGISTER_SQL,
+            {'username': username, 'email': email, 'password_hash': password_hash,
+             'role': role, 'phone': phone}
+        )
+        result = cur.fetchone()
+        conn.commit()
+        
+        if not result['user_id']:
+            conflict = [name for name in ('email', 'username') if result[f'{name}_taken']]
+            if not conflict:
+                # Помешала параллельная регистрация, не попавшая в снимок: новый
+                # запрос видит её строку
+                cur.execute(TAKEN_SQL, {'email': email, 'username': username})
+                recheck = cur.fetchone()
+                conn.commit()
+                conflict = [name for name in ('email', 'username') if recheck[f'{name}_taken']]
             return {
                 'statusCode': 409,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Пользователь с таким email или username уже существует'})
+                'body': json.dumps({
+                    'error': 'Пользователь с таким email или username уже существует',
+                    'conflict': conflict
+                })
             }
         
-        password_hash = hash_password(password)
-        
-        cur.execute(
-            "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
-            (username, email, password_hash)
-        )
-        user_id = cur.fetchone()['id']
-        
-        cur.execute(
-            "INSERT INTO user_profiles (user_id, user_role, phone) VALUES (%s, %s, %s)",
-            (user_id, role, phone)
-        )
-        
-        conn.commit()
+        user_id = result['user_id']
+        if _bloom is not None:
+            _bloom.add(f'e:{email}')
+            _bloom.add(f'u:{username}')
         
         return {
             'statusCode': 201,
@@ -134,7 +795,69 @@ def handle_register(event: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def handle_check(event: dict) -> dict:
+    """Проверка занятости email/username: «свободно» из фильтра Блума, остальное — из БД"""
+    query_params = event.get('queryStringParameters', {}) or {}
+    values = {
+        'email': query_params.get('email', '').strip().lower(),
+        'username': query_params.get('username', '').strip()
+    }
+    values = {name: value for name, value in values.items() if value}
+    
+    if not values:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Укажите email или username'})
+        }
+    
+    BLOOM_STATS['checks'] += 1
+    start_bloom_refresh()
+    bloom = _bloom
+    conn = None
+    
+    try:
+        result = {}
+        maybe_taken = []
+        for name, value in values.items():
+            if bloom is None or f'{name[0]}:{value}' in bloom:
+                maybe_taken.append(name)
+            else:
+                BLOOM_STATS['filter_free'] += 1
+                result[name] = {'available': True, 'source': 'filter'}
+        
+        if maybe_taken:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    """
+                    SELECT EXISTS(SELECT 1 FROM users WHERE email = %(email)s) AS email,
+                           EXISTS(SELECT 1 FROM users WHERE username = %(username)s) AS username
+                    """,
+                    {'email': values.get('email'), 'username': values.get('username')}
+                )
+                taken = cur.fetchone()
+            finally:
+                cur.close()
+            
+            for name in maybe_taken:
+                if bloom is not None:
+                    BLOOM_STATS['db_checks'] += 1
+                    if not taken[name]:
+                        BLOOM_STATS['false_positives'] += 1
+                result[name] = {'available': not taken[name], 'source': 'db'}
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(result)
+        }
+    finally:
+        if conn:
+            release_db_connection(conn)
 
 def handle_login(event: dict) -> dict:
     """Вход в систему"""
@@ -150,23 +873,30 @@ def handle_login(event: dict) -> dict:
             'body': json.dumps({'error': 'Email и password обязательны'})
         }
     
+    # Отказ по лимиту — до поиска пользователя и хеширования пароля
+    buckets = login_buckets(email, get_source_ip(event))
+    wait = max(take_local_token(key, capacity, rate) for _, key, capacity, rate in buckets)
+    if wait:
+        THROTTLE_STATS['rejected_local'] += 1
+        return throttled_response(wait)
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute(
-            """
-            SELECT u.id, u.username, u.email, u.password_hash, u.is_active,
-                   p.user_role, p.phone, p.is_verified
-            FROM users u
-            LEFT JOIN user_profiles p ON u.id = p.user_id
-            WHERE u.email = %s
-            """,
-            (email,)
-        )
+        cur.execute(*login_query(email, buckets))
         user = cur.fetchone()
+        conn.commit()
+        
+        rejected = [bucket for bucket in buckets if not user[f'{bucket[0]}_allowed']]
+        if rejected:
+            THROTTLE_STATS['rejected_shared'] += 1
+            for _, key, _, _ in rejected:
+                drain_local_bucket(key)
+            return throttled_response(max(1 / rate for *_, rate in rejected))
+        THROTTLE_STATS['allowed'] += 1
         
-        if not user or not verify_password(user['password_hash'], password):
+        if not user['id'] or not verify_password(user['password_hash'], password):
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -180,14 +910,48 @@ def handle_login(event: dict) -> dict:
                 'body': json.dumps({'error': 'Аккаунт деактивирован'})
             }
         
+        # Пароль верный: переводим хеш на текущие схему и стоимость
+        if needs_rehash(user['password_hash']):
+            cur.execute(
+                "UPDATE users SET password_hash = %s WHERE id = %s",
+                (hash_password(password), user['id'])
+            )
+        
         token = generate_token()
-        expires_at = datetime.now() + timedelta(days=30)
+        expires_at = datetime.now() + SESSION_TTL
         
         cur.execute(
-            "INSERT INTO user_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-            (user['id'], token, expires_at)
+            """
+            INSERT INTO user_sessions (user_id, token_hash, expires_at, generation)
+            SELECT id, %s, %s, session_generation FROM users WHERE id = %s
+            RETURNING generation
+            """,
+            (token_digest(token), expires_at, user['id'])
         )
+        generation = cur.fetchone()['generation']
         conn.commit()
+        cache_session(token, {
+            'user_id': user['id'],
+            'role': user['user_role'],
+            'expires_at': expires_at,
+            'generation': generation
+        })
+        
+        body = {
+            'message': 'Успешный вход',
+            'token': token,
+            'user': {
+                'id': user['id'],
+                'username': user['username'],
+                'email': user['email'],
+                'role': user['user_role'],
+                'is_verified': user['is_verified']
+            }
+        }
+        access_token = create_access_token(user['id'], user['user_role'], generation)
+        if access_token:
+            body['access_token'] = access_token
+            body['expires_in'] = ACCESS_TOKEN_TTL
         
         return {
             'statusCode': 200,
@@ -196,21 +960,24 @@ def handle_login(event: dict) -> dict:
                 'Access-Control-Allow-Origin': '*',
                 'X-Set-Cookie': f'sparcom_token={token}; Path=/; Max-Age=2592000; SameSite=Lax'
             },
-            'body': json.dumps({
-                'message': 'Успешный вход',
-                'token': token,
-                'user': {
-                    'id': user['id'],
-                    'username': user['username'],
-                    'email': user['email'],
-                    'role': user['user_role'],
-                    'is_verified': user['is_verified']
-                }
-            })
+            'body': json.dumps(body)
         }
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Выход отмечается в session_generation_changed_at без смены поколения: другие
+# контейнеры auth, events и roles по этой отметке забывают сессии пользователя
+# из кеша и перепроверяют их в user_sessions
+LOGOUT_SQL = """
+    WITH ended AS (
+        DELETE FROM user_sessions
+        WHERE token_hash = %s AND expires_at > NOW()
+        RETURNING user_id
+    )
+    UPDATE users SET session_generation_changed_at = NOW()
+    WHERE id IN (SELECT user_id FROM ended)
+"""
 
 def handle_logout(event: dict) -> dict:
     """Выход из системы"""
@@ -227,8 +994,10 @@ def handle_logout(event: dict) -> dict:
     cur = conn.cursor()
     
     try:
-        cur.execute("DELETE FROM user_sessions WHERE token = %s", (token,))
+        cur.execute(LOGOUT_SQL, (token_digest(token),))
         conn.commit()
+        cache_session(token, None)
+        _me_cache.pop(token, None)
         
         return {
             'statusCode': 200,
@@ -241,11 +1010,83 @@ def handle_logout(event: dict) -> dict:
         }
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def handle_logout_all(event: dict) -> dict:
+    """Выход на всех устройствах: одно увеличение поколения вместо удаления всех сессий"""
+    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
+    
+    if not token:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Токен не предоставлен'})
+        }
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            """
+            UPDATE users u
+            SET session_generation = u.session_generation + 1,
+                session_generation_changed_at = NOW()
+            FROM user_sessions s
+            WHERE s.token_hash = %s AND s.expires_at > NOW()
+              AND u.id = s.user_id AND u.session_generation = s.generation
+            RETURNING u.id
+            """,
+            (token_digest(token),)
+        )
+        user = cur.fetchone()
+        conn.commit()
+        
+        if not user:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Недействительный или истекший токен'})
+            }
+        
+        # Другие контейнеры отклонят старые токены по поколению, этот — сразу
+        for cached_token, (_, session) in list(_session_cache.items()):
+            if session and session['user_id'] == user['id']:
+                cache_session(cached_token, None)
+        drop_cached_me(user['id'])
+        SESSION_STATS['revoked'] += 1
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'X-Set-Cookie': 'sparcom_token=; Path=/; Max-Age=0'
+            },
+            'body': json.dumps({'message': 'Выполнен выход на всех устройствах'})
+        }
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+def me_response(entry: dict, if_none_match: str) -> dict:
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'private, no-cache',
+        'ETag': entry['etag']
+    }
+    if if_none_match and entry['etag'] in (tag.strip() for tag in if_none_match.split(',')):
+        ME_STATS['not_modified'] += 1
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    return {'statusCode': 200, 'headers': headers, 'body': entry['body']}
 
 def handle_get_user(event: dict) -> dict:
     """Получить данные текущего пользователя"""
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
+    request_headers = event.get('headers', {}) or {}
+    token = request_headers.get('X-Authorization', '').replace('Bearer ', '')
+    if_none_match = request_headers.get('If-None-Match') or request_headers.get('if-none-match')
     
     if not token:
         return {
@@ -254,6 +1095,31 @@ def handle_get_user(event: dict) -> dict:
             'body': json.dumps({'error': 'Токен не предоставлен'})
         }
     
+    hit, session = cached_session(token)
+    if hit and session is None:
+        SESSION_STATS['hits'] += 1
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Недействительный или истекший токен'})
+        }
+    
+    if _me_cache.get(token) and me_poll_due():
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                poll_profile_changes(cur)
+        finally:
+            release_db_connection(conn)
+    
+    entry = cached_me(token)
+    if entry:
+        ME_STATS['hits'] += 1
+        touch_session(token, entry['session'])
+        return me_response(entry, if_none_match)
+    ME_STATS['misses'] += 1
+    SESSION_STATS['misses'] += 1
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
@@ -261,28 +1127,38 @@ def handle_get_user(event: dict) -> dict:
         cur.execute(
             """
             SELECT u.id, u.username, u.email, u.first_name, u.last_name,
-                   p.user_role, p.phone, p.bio, p.is_verified
+                   p.user_role, p.phone, p.bio, p.is_verified,
+                   s.expires_at AS session_expires_at, s.generation AS session_generation
             FROM user_sessions s
-            JOIN users u ON s.user_id = u.id
+            JOIN users u ON s.user_id = u.id AND u.session_generation = s.generation
             LEFT JOIN user_profiles p ON u.id = p.user_id
-            WHERE s.token = %s AND s.expires_at > NOW()
+            WHERE s.token_hash = %s AND s.expires_at > NOW()
             """,
-            (token,)
+            (token_digest(token),)
         )
         user = cur.fetchone()
         
         if not user:
+            cache_session(token, None)
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({'error': 'Недействительный или истекший токен'})
             }
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'user': dict(user)})
+        user = dict(user)
+        session = {
+            'user_id': user['id'],
+            'role': user['user_role'],
+            'expires_at': user.pop('session_expires_at'),
+            'generation': user.pop('session_generation')
         }
+        cache_session(token, session)
+        touch_session(token, session)
+        if me_poll_due():
+            poll_profile_changes(cur)
+        
+        return me_response(cache_me(token, session, json.dumps({'user': user})), if_none_match)
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
@@ -1,7 +1,668 @@
+import base64
+import hashlib
+import hmac
 import json
 import os
+import re
+import jwt
 import psycopg2
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+DB_PING_INTERVAL = 30
+
+# Соединение переживает вызов и переиспользуется тёплым контейнером
+_db_conn = None
+_db_last_used = 0.0
+DB_STATS = {'connects': 0, 'reuses': 0, 'reconnects': 0}
+
+def ping_connection(conn) -> bool:
+    '''Дешёвая проверка живости соединения'''
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        if not conn.autocommit:
+            conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Соединение с БД: тёплое из прошлого вызова или новое'''
+    global _db_conn
+    
+    conn = _db_conn
+    if conn is not None and not conn.closed:
+        if time.monotonic() - _db_last_used < DB_PING_INTERVAL or ping_connection(conn):
+            DB_STATS['reuses'] += 1
+            return conn
+        DB_STATS['reconnects'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    _db_conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    DB_STATS['connects'] += 1
+    return _db_conn
+
+def release_db_connection(conn) -> None:
+    '''Конец вызова: сбрасываем незавершённую транзакцию, дописываем продления сессий,
+    соединение не закрываем'''
+    global _db_last_used
+    
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        flush_session_extensions(conn)
+        _db_last_used = time.monotonic()
+    except psycopg2.Error:
+        conn.close()
+
+# Поле ответа -> колонка таблицы events (порядок задаёт порядок полей в ответе)
+EVENT_FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'description': 'description',
+    'bathhouse_id': 'bathhouse_id',
+    'master_id': 'master_id',
+    'organizer_id': 'organizer_id',
+    'event_date': 'event_date',
+    'duration_hours': 'duration_hours',
+    'max_participants': 'max_participants',
+    'current_participants': 'current_participants',
+    'price_per_person': 'price_per_person',
+    'status': 'event_status',
+    'created_at': 'created_at'
+}
+TIMESTAMP_FIELDS = {'event_date', 'created_at'}
+
+# Ответы list/get собираются в JSON самим PostgreSQL и отдаются без разбора;
+# SQL_JSON=0 возвращает сборку словарей в Python (для сравнения)
+SQL_JSON = os.environ.get('SQL_JSON', '1') != '0'
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_BATCH_SIZE = 100
+MAX_SEARCH_WORDS = 8
+
+SESSION_CACHE_SIZE = 1024
+SESSION_CACHE_TTL = 60
+SESSION_NEGATIVE_TTL = 10
+
+# token -> (момент записи, сессия или None); порядок ключей = порядок использования
+_session_cache = OrderedDict()
+SESSION_STATS = {'hits': 0, 'misses': 0, 'jwt': 0, 'extended': 0, 'revoked': 0}
+
+def cache_session(token: str, session) -> None:
+    '''Запоминает сессию (или её отсутствие) для токена'''
+    _session_cache[token] = (time.monotonic(), session)
+    _session_cache.move_to_end(token)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+
+def cached_session(token: str) -> tuple:
+    '''(найдено в кеше, сессия или None) без обращения к БД'''
+    entry = _session_cache.get(token)
+    if entry is None:
+        return False, None
+    
+    stored_at, session = entry
+    ttl = SESSION_CACHE_TTL if session else SESSION_NEGATIVE_TTL
+    if time.monotonic() - stored_at >= ttl or (session and session['expires_at'] <= datetime.now()):
+        del _session_cache[token]
+        return False, None
+    
+    _session_cache.move_to_end(token)
+    return True, session
+
+# JWT_KEYS='{"kid": "секрет", ...}' держит текущий и предыдущие ключи на время ротации,
+# JWT_SECRET — одиночный ключ с kid "default"
+_jwt_keys = None
+
+def get_jwt_keys() -> dict:
+    '''Ключи подписи access-токенов: kid -> секрет'''
+    global _jwt_keys
+    
+    if _jwt_keys is None:
+        keys = json.loads(os.environ.get('JWT_KEYS') or '{}')
+        if os.environ.get('JWT_SECRET'):
+            keys.setdefault('default', os.environ['JWT_SECRET'])
+        _jwt_keys = keys
+    return _jwt_keys
+
+def verify_access_token(token: str):
+    '''Сессия из claims подписанного JWT или None, без обращения к БД'''
+    keys = get_jwt_keys()
+    try:
+        kid = jwt.get_unverified_header(token).get('kid', 'default')
+        if kid not in keys:
+            return None
+        claims = jwt.decode(token, keys[kid], algorithms=['HS256'], options={'require': ['exp', 'user_id']})
+    except jwt.InvalidTokenError:
+        return None
+    
+    return {
+        'user_id': claims['user_id'],
+        'role': claims.get('role'),
+        'expires_at': datetime.fromtimestamp(claims['exp']),
+        'generation': claims.get('gen', 0)
+    }
+
+def is_jwt(token: str) -> bool:
+    '''Непрозрачные токены сессий не содержат точек, JWT — ровно две'''
+    return token.count('.') == 2
+
+def token_digest(token: str) -> bytes:
+    '''В user_sessions хранится SHA-256 токена, а не сам токен'''
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+# Непрозрачный токен: сессия живого поколения с ролью пользователя
+SESSION_SQL = """
+    SELECT s.user_id, p.user_role, s.expires_at, s.generation
+    FROM user_sessions s
+    JOIN users u ON u.id = s.user_id AND u.session_generation = s.generation
+    LEFT JOIN user_profiles p ON p.user_id = s.user_id
+    WHERE s.token_hash = %s AND s.expires_at > NOW()
+"""
+
+def resolve_session(cur, token: str):
+    '''Сессия по токену: {'user_id', 'role', 'expires_at', 'generation'} или None.
+    
+    JWT проверяется локально по подписи, непрозрачный токен — одним запросом к БД.
+    Токены отозванного поколения (action=logout_all в auth) не принимаются.
+    '''
+    if is_jwt(token):
+        SESSION_STATS['jwt'] += 1
+        session = verify_access_token(token)
+        return None if session is None or is_revoked(cur, session) else session
+    
+    # Опрос до кеша: сессии пользователей, вышедших в других контейнерах, из него уже убраны
+    poll_generations(cur)
+    hit, session = cached_session(token)
+    if hit:
+        SESSION_STATS['hits'] += 1
+        if session is not None and is_revoked(cur, session):
+            cache_session(token, None)
+            return None
+        touch_session(token, session)
+        return session
+    
+    SESSION_STATS['misses'] += 1
+    cur.execute(SESSION_SQL, (token_digest(token),))
+    row = cur.fetchone()
+    session = {'user_id': row[0], 'role': row[1], 'expires_at': row[2], 'generation': row[3]} if row else None
+    cache_session(token, session)
+    touch_session(token, session)
+    return session
+
+# Поколение сессий пользователя: auth?action=logout_all увеличивает users.session_generation.
+# Контейнер не чаще раза в GENERATION_POLL_INTERVAL забирает недавно изменённые поколения,
+# по ним отклоняются JWT и сессии из кеша; при холодном старте — изменения за
+# GENERATION_LOOKBACK, что дольше жизни JWT и записей кеша. Обычный выход в auth
+# обновляет только session_generation_changed_at: сессии такого пользователя
+# удаляются из кеша и при следующем запросе перепроверяются в user_sessions
+GENERATION_POLL_INTERVAL = 5
+GENERATION_OVERLAP = timedelta(seconds=10)
+GENERATION_LOOKBACK = timedelta(hours=1)
+_generations = {}
+_session_stamps = {}
+_generations_since = None
+_generations_polled_at = 0.0
+
+def poll_generations(cur) -> None:
+    '''Подтягивает поколения, изменённые с прошлого опроса'''
+    global _generations_since, _generations_polled_at
+    
+    if _generations_since is not None and time.monotonic() - _generations_polled_at < GENERATION_POLL_INTERVAL:
+        return
+    
+    # Отметка опроса берётся с часов БД: ими же проставлен session_generation_changed_at
+    cur.execute(
+        """SELECT LOCALTIMESTAMP, u.id, u.session_generation, u.session_generation_changed_at
+           FROM (SELECT 1) AS one
+           LEFT JOIN users u
+             ON u.session_generation_changed_at > COALESCE(%s::timestamp - %s, LOCALTIMESTAMP - %s)""",
+        (_generations_since, GENERATION_OVERLAP, GENERATION_LOOKBACK)
+    )
+    changed = set()
+    for polled_at, user_id, generation, changed_at in cur.fetchall():
+        if user_id is None:
+            continue
+        _generations[user_id] = max(generation, _generations.get(user_id, 0))
+        if user_id not in _session_stamps or changed_at > _session_stamps[user_id]:
+            _session_stamps[user_id] = changed_at
+            changed.add(user_id)
+    if changed:
+        for token, (_, session) in list(_session_cache.items()):
+            if session and session['user_id'] in changed:
+                del _session_cache[token]
+    _generations_since = polled_at
+    _generations_polled_at = time.monotonic()
+
+def is_revoked(cur, session: dict) -> bool:
+    poll_generations(cur)
+    if session['generation'] < _generations.get(session['user_id'], 0):
+        SESSION_STATS['revoked'] += 1
+        return True
+    return False
+
+# Скользящий срок сессии: продление не чаще раза в SESSION_EXTEND_INTERVAL на токен.
+# Момент прошлого продления виден по expires_at (оно всегда равно продлению + SESSION_TTL),
+# продления копятся в памяти и записываются одним UPDATE при освобождении соединения
+SESSION_TTL = timedelta(days=30)
+SESSION_EXTEND_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_EXTEND_INTERVAL', '3600')))
+SESSION_FLUSH_INTERVAL = 30
+SESSION_FLUSH_BATCH = 100
+_pending_extensions = set()
+_pending_since = 0.0
+
+def touch_session(token: str, session) -> None:
+    '''Ставит непрозрачную сессию в очередь на продление, если подошёл её срок'''
+    global _pending_since
+    
+    if session is None:
+        return
+    extended = datetime.now() + SESSION_TTL
+    if extended - session['expires_at'] < SESSION_EXTEND_INTERVAL:
+        return
+    
+    # Сессия в кеше — тот же объект: следующие запросы в контейнере её уже не продлевают
+    session['expires_at'] = extended
+    if not _pending_extensions:
+        _pending_since = time.monotonic()
+    _pending_extensions.add(token_digest(token))
+
+def flush_session_extensions(conn) -> None:
+    '''Записывает накопленные продления, когда их много или они копятся дольше SESSION_FLUSH_INTERVAL'''
+    if not _pending_extensions:
+        return
+    if len(_pending_extensions) < SESSION_FLUSH_BATCH and time.monotonic() - _pending_since < SESSION_FLUSH_INTERVAL:
+        return
+    
+    token_hashes = list(_pending_extensions)
+    _pending_extensions.clear()
+    with conn.cursor() as cur:
+        cur.execute(
+            """UPDATE user_sessions SET expires_at = NOW() + %s
+               WHERE token_hash = ANY(%s) AND expires_at > NOW()""",
+            (SESSION_TTL, token_hashes)
+        )
+        SESSION_STATS['extended'] += cur.rowcount
+    conn.commit()
+
+def parse_fields(raw) -> list:
+    '''Список запрошенных полей из параметра fields= (по умолчанию все)'''
+    if not raw:
+        return list(EVENT_FIELDS)
+    
+    fields = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in EVENT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    return list(dict.fromkeys(fields))
+
+def parse_limit(raw) -> int:
+    '''Размер страницы из параметра limit= в пределах 1..MAX_PAGE_SIZE'''
+    if not raw:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise ValueError('Некорректный limit')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(sort_key, event_id: int) -> str:
+    '''Курсор страницы: ключ сортировки и id последней отданной строки'''
+    sort_key = sort_key.isoformat() if isinstance(sort_key, datetime) else str(sort_key)
+    raw = json.dumps([sort_key, event_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, parse_key=datetime.fromisoformat) -> tuple:
+    '''Разбор курсора из параметра after='''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_key, event_id = json.loads(base64.urlsafe_b64decode(padded))
+        return parse_key(sort_key), int(event_id)
+    except (ValueError, TypeError, ArithmeticError):
+        raise ValueError('Некорректный курсор')
+
+def build_tsquery(raw: str) -> str:
+    '''Запрос to_tsquery из пользовательского текста: все слова, каждое как префикс'''
+    words = re.findall(r'[^\W_]+', raw.lower())[:MAX_SEARCH_WORDS]
+    if not words:
+        raise ValueError('Пустой поисковый запрос')
+    return ' & '.join(f'{word}:*' for word in words)
+
+def json_object_sql(fields: list) -> str:
+    '''Аргументы json_build_object для запрошенных полей: 'title', title, ...'''
+    return ', '.join(f"'{name}', {EVENT_FIELDS[name]}" for name in fields)
+
+def parse_ids(raw: str) -> list:
+    '''Список ID из параметра ids= в порядке запроса, без повторов'''
+    ids = [value.strip() for value in raw.split(',') if value.strip()]
+    if not ids or not all(value.isdigit() for value in ids):
+        raise ValueError('Некорректный список ID')
+    ids = list(dict.fromkeys(int(value) for value in ids))
+    if len(ids) > MAX_BATCH_SIZE:
+        raise ValueError(f'Не больше {MAX_BATCH_SIZE} ID за запрос')
+    return ids
+
+def row_to_event(fields: list, row: tuple) -> dict:
+    '''Строка выборки -> словарь события только с запрошенными полями'''
+    event_data = {}
+    for name, value in zip(fields, row):
+        if name in TIMESTAMP_FIELDS:
+            value = value.isoformat() if value else None
+        event_data[name] = value
+    return event_data
+
+def get_header(event: dict, name: str) -> str:
+    '''Заголовок запроса без учёта регистра имени'''
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def metrics_allowed(event: dict) -> bool:
+    '''Счётчики отдаются только с заголовком X-Metrics-Token, равным секрету METRICS_TOKEN'''
+    expected = os.environ.get('METRICS_TOKEN', '')
+    provided = get_header(event, 'X-Metrics-Token')
+    return bool(expected) and hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
+
+def make_etag(*parts) -> str:
+    '''Слабый ETag из версии данных и параметров запроса'''
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+def etag_matches(event: dict, etag: str) -> bool:
+    '''Совпадает ли ETag с одним из значений If-None-Match'''
+    candidates = [value.strip() for value in get_header(event, 'If-None-Match').split(',')]
+    return etag in candidates or '*' in candidates
+
+def not_modified(headers: dict, etag: str) -> dict:
+    return {
+        'statusCode': 304,
+        'headers': {**headers, 'ETag': etag, 'Cache-Control': 'no-cache'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+# Версия данных списка по статусу: сумма строк счётчика events_version, который
+# триггер на events сдвигает в транзакции записи (несколько строк по первичному ключу)
+LIST_STAMP_SQL = "SELECT sum(version)::text FROM events_version WHERE event_status = %s"
+
+LIST_STAMP_ALL_SQL = """
+    SELECT string_agg(event_status || ':' || version, '.' ORDER BY event_status)
+    FROM (SELECT event_status, sum(version) AS version
+          FROM events_version GROUP BY event_status) AS versions
+"""
+
+# xmin строки меняется при каждой её записи: версия для условных запросов get
+EVENT_STAMP_SQL = "SELECT xmin::text FROM events WHERE id = %s"
+
+BATCH_STAMP_SQL = "SELECT string_agg(id || ':' || xmin::text, '.' ORDER BY id) FROM events WHERE id = ANY(%s)"
+
+def list_page_query(fields: list, conditions: list, args: list, limit: int) -> tuple:
+    '''Запрос страницы списка (keyset по (event_date, id)) и его параметры'''
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    columns = ', '.join(EVENT_FIELDS[name] for name in fields)
+    
+    if SQL_JSON:
+        return (
+            f"""WITH page AS (
+                    SELECT {columns}, event_date AS cursor_date, id AS cursor_id,
+                           row_number() OVER (ORDER BY event_date ASC, id ASC) AS n
+                    FROM events
+                    {where}
+                    ORDER BY event_date ASC, id ASC
+                    LIMIT %s
+                )
+                SELECT COALESCE(json_agg(json_build_object({json_object_sql(fields)}) ORDER BY n)
+                                FILTER (WHERE n <= %s), '[]')::text,
+                       MAX(cursor_date) FILTER (WHERE n = %s),
+                       MAX(cursor_id) FILTER (WHERE n = %s),
+                       COUNT(*) > %s
+                FROM page""",
+            (*args, limit + 1, limit, limit, limit, limit)
+        )
+    return (
+        f"""SELECT {columns}, event_date, id
+            FROM events
+            {where}
+            ORDER BY event_date ASC, id ASC
+            LIMIT %s""",
+        (*args, limit + 1)
+    )
+
+def get_events_batch(cur, event: dict, headers: dict) -> dict:
+    '''Несколько событий по ids= одним запросом, в порядке запроса'''
+    params = event.get('queryStringParameters', {})
+    try:
+        ids = parse_ids(params['ids'])
+        fields = parse_fields(params.get('fields'))
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    if get_header(event, 'If-None-Match'):
+        cur.execute(BATCH_STAMP_SQL, (ids,))
+        etag = make_etag('batch', ids, ','.join(fields), cur.fetchone()[0], SQL_JSON)
+        if etag_matches(event, etag):
+            return not_modified(headers, etag)
+    
+    if SQL_JSON:
+        cur.execute(
+            f"""SELECT COALESCE(json_agg(json_build_object({json_object_sql(fields)}) ORDER BY req.ord)
+                                FILTER (WHERE events.id IS NOT NULL), '[]')::text,
+                       COALESCE(array_agg(req.event_id ORDER BY req.ord) FILTER (WHERE events.id IS NULL), '{{}}'),
+                       string_agg(events.id || ':' || events.xmin::text, '.' ORDER BY events.id)
+                FROM unnest(%s::int[]) WITH ORDINALITY AS req(event_id, ord)
+                LEFT JOIN events ON events.id = req.event_id""",
+            (ids,)
+        )
+        events_json, missing, stamp = cur.fetchone()
+        body = f'{{"events": {events_json}, "missing": {json.dumps(missing)}}}'
+    else:
+        columns = ', '.join(EVENT_FIELDS[name] for name in fields)
+        cur.execute(
+            f"SELECT {columns}, id, xmin::text FROM events WHERE id = ANY(%s) ORDER BY id",
+            (ids,)
+        )
+        rows = {row[-2]: row for row in cur.fetchall()}
+        stamp = '.'.join(f'{row[-2]}:{row[-1]}' for row in rows.values()) or None
+        events = [row_to_event(fields, rows[event_id]) for event_id in ids if event_id in rows]
+        missing = [event_id for event_id in ids if event_id not in rows]
+        body = json.dumps({'events': events, 'missing': missing})
+    
+    etag = make_etag('batch', ids, ','.join(fields), stamp, SQL_JSON)
+    return {
+        'statusCode': 200,
+        'headers': {**headers, 'ETag': etag, 'Cache-Control': 'no-cache'},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def search_events(cur, event: dict, headers: dict) -> dict:
+    '''Полнотекстовый поиск по title/description с ранжированием и keyset-пагинацией'''
+    params = event.get('queryStringParameters', {})
+    status_filter = params.get('status', 'published')
+    
+    try:
+        tsquery = build_tsquery(params.get('q', ''))
+        fields = parse_fields(params.get('fields'))
+        limit = parse_limit(params.get('limit'))
+        after = decode_cursor(params['after'], Decimal) if params.get('after') else None
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    args = [tsquery]
+    status_condition = ''
+    if status_filter != 'all':
+        status_condition = 'AND event_status = %s'
+        args.append(status_filter)
+    
+    # Ранг округляется, чтобы значение из курсора сравнивалось с пересчитанным точно
+    after_condition = ''
+    if after:
+        after_condition = 'WHERE rank < %s OR (rank = %s AND id > %s)'
+        args.extend([after[0], after[0], after[1]])
+    
+    columns = ', '.join(EVENT_FIELDS[name] for name in fields)
+    cur.execute(
+        f"""SELECT {columns}, rank, id
+            FROM (
+                SELECT events.*, round(ts_rank(search_vector, query)::numeric, 6) AS rank
+                FROM events, to_tsquery('russian', %s) AS query
+                WHERE search_vector @@ query {status_condition}
+            ) hits
+            {after_condition}
+            ORDER BY rank DESC, id ASC
+            LIMIT %s""",
+        (*args, limit + 1)
+    )
+    rows = cur.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps({
+            'events': [row_to_event(fields, row) for row in rows],
+            'next_cursor': next_cursor
+        }),
+        'isBase64Encoded': False
+    }
+
+# Место резервирует условный UPDATE, бронь вставляется в том же выражении
+BOOK_SQL = """
+    WITH seat AS (
+        UPDATE events
+        SET current_participants = current_participants + 1,
+            event_status = CASE WHEN current_participants + 1 >= max_participants
+                                THEN 'full' ELSE event_status END
+        WHERE id = %s AND event_status = 'published' AND event_date > NOW()
+          AND current_participants < max_participants
+        RETURNING id, price_per_person, current_participants, max_participants, event_status
+    ), booking AS (
+        INSERT INTO bookings (event_id, user_id, booking_status, total_price, created_at)
+        SELECT id, %s, 'pending', price_per_person, NOW() FROM seat
+        ON CONFLICT (event_id, user_id) DO UPDATE
+        SET booking_status = 'pending', payment_status = 'pending',
+            total_price = EXCLUDED.total_price, created_at = EXCLUDED.created_at,
+            confirmed_at = NULL
+        WHERE bookings.booking_status = 'cancelled'
+        RETURNING id
+    )
+    SELECT booking.id, seat.current_participants, seat.max_participants, seat.event_status
+    FROM seat LEFT JOIN booking ON TRUE
+"""
+
+CANCEL_SQL = """
+    WITH booking AS (
+        UPDATE bookings
+        SET booking_status = 'cancelled'
+        WHERE event_id = %s AND user_id = %s AND booking_status IN ('pending', 'confirmed')
+        RETURNING event_id
+    )
+    UPDATE events
+    SET current_participants = current_participants - 1,
+        event_status = CASE WHEN event_status = 'full' THEN 'published' ELSE event_status END
+    WHERE id IN (SELECT event_id FROM booking)
+    RETURNING current_participants, max_participants, event_status
+"""
+
+def book_seat(conn, cur, event_id: int, user_id: int, headers: dict) -> dict:
+    '''Бронирование места одним запросом.
+    
+    Условный UPDATE резервирует место под блокировкой строки события только на время
+    выполнения запроса и коммита, INSERT в bookings идёт в том же выражении.
+    '''
+    cur.execute(BOOK_SQL, (event_id, user_id))
+    row = cur.fetchone()
+    
+    if row and row[0]:
+        conn.commit()
+        return {
+            'statusCode': 201,
+            'headers': headers,
+            'body': json.dumps({
+                'success': True,
+                'booking_id': row[0],
+                'current_participants': row[1],
+                'max_participants': row[2],
+                'status': row[3]
+            }),
+            'isBase64Encoded': False
+        }
+    
+    # Место не занято или занятое место нужно вернуть: разбираемся, почему
+    conn.rollback()
+    if row:
+        status, error = 409, 'Вы уже записаны на это событие'
+    else:
+        cur.execute(
+            "SELECT event_status, event_date > NOW() FROM events WHERE id = %s",
+            (event_id,)
+        )
+        state = cur.fetchone()
+        if not state:
+            status, error = 404, 'Событие не найдено'
+        elif state[0] == 'full' or (state[0] == 'published' and state[1]):
+            status, error = 409, 'Свободных мест нет'
+        else:
+            status, error = 400, 'Запись на событие закрыта'
+    
+    return {
+        'statusCode': status,
+        'headers': headers,
+        'body': json.dumps({'error': error}),
+        'isBase64Encoded': False
+    }
+
+def cancel_booking(conn, cur, event_id: int, user_id: int, headers: dict) -> dict:
+    '''Отмена брони и возврат места одним запросом'''
+    cur.execute(CANCEL_SQL, (event_id, user_id))
+    row = cur.fetchone()
+    conn.commit()
+    
+    if not row:
+        return {
+            'statusCode': 404,
+            'headers': headers,
+            'body': json.dumps({'error': 'Бронирование не найдено'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps({
+            'success': True,
+            'current_participants': row[0],
+            'max_participants': row[1],
+            'status': row[2]
+        }),
+        'isBase64Encoded': False
+    }
 
 def handler(event: dict, context) -> dict:
     '''API для управления банными событиями и встречами'''
@@ -14,7 +675,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization'
+                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization, If-None-Match'
             },
             'body': '',
             'isBase64Encoded': False
@@ -22,55 +683,96 @@ def handler(event: dict, context) -> dict:
     
     headers = {
         'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag'
     }
     
     action = event.get('queryStringParameters', {}).get('action', 'list')
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    if action == 'metrics':
+        if not metrics_allowed(event):
+            return {
+                'statusCode': 403,
+                'headers': headers,
+                'body': json.dumps({'error': 'Доступ запрещён'}),
+                'isBase64Encoded': False
+            }
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({'db': DB_STATS, 'sessions': SESSION_STATS}),
+            'isBase64Encoded': False
+        }
+    
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
         if action == 'list':
-            status_filter = event.get('queryStringParameters', {}).get('status', 'published')
+            params = event.get('queryStringParameters', {})
+            status_filter = params.get('status', 'published')
             
-            cur.execute(
-                """SELECT id, title, description, bathhouse_id, master_id, organizer_id,
-                          event_date, duration_hours, max_participants, current_participants,
-                          price_per_person, event_status, created_at
-                   FROM events
-                   WHERE event_status = %s OR %s = 'all'
-                   ORDER BY event_date ASC""",
-                (status_filter, status_filter)
-            )
+            try:
+                fields = parse_fields(params.get('fields'))
+                limit = parse_limit(params.get('limit'))
+                after = decode_cursor(params['after']) if params.get('after') else None
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': headers,
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
+            
+            # Дешёвая версия данных вместо полного запроса; читается до страницы, поэтому
+            # ETag не бывает новее отданных данных
+            if status_filter == 'all':
+                cur.execute(LIST_STAMP_ALL_SQL)
+            else:
+                cur.execute(LIST_STAMP_SQL, (status_filter,))
+            stamp = cur.fetchone()
+            etag = make_etag('list', stamp[0] if stamp else None, status_filter,
+                             ','.join(fields), limit, params.get('after'), SQL_JSON)
+            
+            if etag_matches(event, etag):
+                return not_modified(headers, etag)
+            
+            conditions = []
+            args = []
+            if status_filter != 'all':
+                conditions.append('event_status = %s')
+                args.append(status_filter)
+            if after:
+                conditions.append('(event_date, id) > (%s, %s)')
+                args.extend(after)
             
-            events = []
-            for row in cur.fetchall():
-                events.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'description': row[2],
-                    'bathhouse_id': row[3],
-                    'master_id': row[4],
-                    'organizer_id': row[5],
-                    'event_date': row[6].isoformat() if row[6] else None,
-                    'duration_hours': row[7],
-                    'max_participants': row[8],
-                    'current_participants': row[9],
-                    'price_per_person': row[10],
-                    'status': row[11],
-                    'created_at': row[12].isoformat() if row[12] else None
-                })
+            cur.execute(*list_page_query(fields, conditions, args, limit))
+            if SQL_JSON:
+                events_json, cursor_date, cursor_id, has_more = cur.fetchone()
+                next_cursor = encode_cursor(cursor_date, cursor_id) if has_more else None
+                body = f'{{"events": {events_json}, "next_cursor": {json.dumps(next_cursor)}}}'
+            else:
+                rows = cur.fetchall()
+                
+                next_cursor = None
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+                
+                events = [row_to_event(fields, row) for row in rows]
+                body = json.dumps({'events': events, 'next_cursor': next_cursor})
             
             return {
                 'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({'events': events}),
+                'headers': {**headers, 'ETag': etag, 'Cache-Control': 'no-cache'},
+                'body': body,
                 'isBase64Encoded': False
             }
         
         elif action == 'get':
+            if event.get('queryStringParameters', {}).get('ids'):
+                return get_events_batch(cur, event, headers)
+            
             event_id = event.get('queryStringParameters', {}).get('id')
             
             if not event_id:
@@ -81,14 +783,31 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            cur.execute(
-                """SELECT id, title, description, bathhouse_id, master_id, organizer_id,
-                          event_date, duration_hours, max_participants, current_participants,
-                          price_per_person, event_status, created_at
-                   FROM events
-                   WHERE id = %s""",
-                (event_id,)
-            )
+            # xmin строки меняется при каждой её записи; для условного запроса
+            # сначала сверяем только его
+            if get_header(event, 'If-None-Match'):
+                cur.execute(EVENT_STAMP_SQL, (event_id,))
+                stamp = cur.fetchone()
+                etag = make_etag('get', event_id, stamp[0], SQL_JSON) if stamp else None
+                if etag and etag_matches(event, etag):
+                    return not_modified(headers, etag)
+            
+            if SQL_JSON:
+                cur.execute(
+                    f"""SELECT xmin::text, json_build_object({json_object_sql(list(EVENT_FIELDS))})::text
+                        FROM events
+                        WHERE id = %s""",
+                    (event_id,)
+                )
+            else:
+                cur.execute(
+                    """SELECT xmin::text, id, title, description, bathhouse_id, master_id, organizer_id,
+                              event_date, duration_hours, max_participants, current_participants,
+                              price_per_person, event_status, created_at
+                       FROM events
+                       WHERE id = %s""",
+                    (event_id,)
+                )
             
             row = cur.fetchone()
             
@@ -100,26 +819,16 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            event_data = {
-                'id': row[0],
-                'title': row[1],
-                'description': row[2],
-                'bathhouse_id': row[3],
-                'master_id': row[4],
-                'organizer_id': row[5],
-                'event_date': row[6].isoformat() if row[6] else None,
-                'duration_hours': row[7],
-                'max_participants': row[8],
-                'current_participants': row[9],
-                'price_per_person': row[10],
-                'status': row[11],
-                'created_at': row[12].isoformat() if row[12] else None
-            }
+            etag = make_etag('get', event_id, row[0], SQL_JSON)
+            if SQL_JSON:
+                body = f'{{"event": {row[1]}}}'
+            else:
+                body = json.dumps({'event': row_to_event(list(EVENT_FIELDS), row[1:])})
             
             return {
                 'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({'event': event_data}),
+                'headers': {**headers, 'ETag': etag, 'Cache-Control': 'no-cache'},
+                'body': body,
                 'isBase64Encoded': False
             }
         
@@ -134,8 +843,7 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            cur.execute("SELECT user_id FROM user_sessions WHERE token = %s", (token,))
-            session = cur.fetchone()
+            session = resolve_session(cur, token)
             
             if not session:
                 return {
@@ -145,12 +853,9 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            user_id = session[0]
+            user_id = session['user_id']
             
-            cur.execute("SELECT user_role FROM user_profiles WHERE user_id = %s", (user_id,))
-            profile = cur.fetchone()
-            
-            if not profile or profile[0] not in ['organizer', 'master']:
+            if session['role'] not in ['organizer', 'master']:
                 return {
                     'statusCode': 403,
                     'headers': headers,
@@ -201,6 +906,36 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
+        elif action == 'search':
+            return search_events(cur, event, headers)
+        
+        elif action in ('book', 'cancel'):
+            token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
+            session = resolve_session(cur, token) if token else None
+            
+            if not session:
+                return {
+                    'statusCode': 401,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Требуется авторизация'}),
+                    'isBase64Encoded': False
+                }
+            
+            body = json.loads(event.get('body') or '{}')
+            event_id = str(body.get('event_id') or '')
+            
+            if not event_id.isdigit():
+                return {
+                    'statusCode': 400,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Не указан ID события'}),
+                    'isBase64Encoded': False
+                }
+            
+            if action == 'book':
+                return book_seat(conn, cur, int(event_id), session['user_id'], headers)
+            return cancel_booking(conn, cur, int(event_id), session['user_id'], headers)
+        
         else:
             return {
                 'statusCode': 400,
@@ -211,4 +946,4 @@ def handler(event: dict, context) -> dict:
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
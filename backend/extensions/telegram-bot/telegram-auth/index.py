@@ -6,16 +6,19 @@ Flow:
 1. User clicks "Login via Telegram" -> redirect to bot
 2. Bot generates unique auth link and sends to user
 3. User clicks link -> frontend exchanges token for JWT
-4. Refresh tokens stored hashed (SHA256) in DB
+4. Refresh tokens stored hashed (SHA256) in DB, rotated on every refresh
 """
 
 import json
 import os
 import hashlib
+import hmac
 import secrets
+import time
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 import psycopg2
+import psycopg2.errors
 import jwt
 
 
@@ -23,12 +26,60 @@ import jwt
 # CONFIGURATION
 # =============================================================================
 
+DB_PING_INTERVAL = 30
+
+# Warm containers keep the connection between invocations
+_db_conn = None
+_db_last_used = 0.0
+DB_STATS = {"connects": 0, "reuses": 0, "reconnects": 0}
+
+
+def ping_connection(conn) -> bool:
+    """Cheap liveness check for a cached connection."""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
 def get_db_connection():
+    """Return the warm connection from a previous invocation or open a new one."""
+    global _db_conn
+
+    conn = _db_conn
+    if conn is not None and not conn.closed:
+        if time.monotonic() - _db_last_used < DB_PING_INTERVAL or ping_connection(conn):
+            DB_STATS["reuses"] += 1
+            return conn
+        DB_STATS["reconnects"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
     conn = psycopg2.connect(os.environ["DATABASE_URL"])
     conn.autocommit = True
+    _db_conn = conn
+    DB_STATS["connects"] += 1
     return conn
 
 
+def release_db_connection(conn) -> None:
+    """End of invocation: reset transaction state but keep the connection open."""
+    global _db_last_used
+
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        _db_last_used = time.monotonic()
+    except psycopg2.Error:
+        conn.close()
+
+
 def get_schema() -> str:
     """Get database schema prefix."""
     schema = os.environ.get("MAIN_DB_SCHEMA", "public")
@@ -54,204 +105,331 @@ def generate_token(length: int = 32) -> str:
     return secrets.token_urlsafe(length)
 
 
-def create_jwt(user_id: int, secret: str, expires_in: int = 900) -> str:
+# JWT_KEYS='{"kid": "secret", ...}' holds the current and previous keys during
+# rotation, JWT_ACTIVE_KID picks the signing key, JWT_SECRET is the "default" kid
+_jwt_keys = None
+
+
+def get_jwt_keys() -> dict:
+    """Access token signing keys: kid -> secret."""
+    global _jwt_keys
+
+    if _jwt_keys is None:
+        keys = json.loads(os.environ.get("JWT_KEYS") or "{}")
+        if os.environ.get("JWT_SECRET"):
+            keys.setdefault("default", os.environ["JWT_SECRET"])
+        _jwt_keys = keys
+    return _jwt_keys
+
+
+def get_signing_key() -> tuple:
+    """Active (kid, secret) pair for signing access tokens."""
+    kid = os.environ.get("JWT_ACTIVE_KID", "default")
+    secret = get_jwt_keys().get(kid)
+    if not secret:
+        raise ValueError(f"Missing JWT signing key: {kid}")
+    return kid, secret
+
+
+def create_jwt(
+    user_id: int,
+    secret: str,
+    expires_in: int = 900,
+    role: Optional[str] = None,
+    kid: str = "default",
+    generation: int = 0
+) -> str:
     payload = {
         "user_id": user_id,
+        "gen": generation,
         "exp": datetime.now(timezone.utc) + timedelta(seconds=expires_in),
         "iat": datetime.now(timezone.utc),
     }
-    return jwt.encode(payload, secret, algorithm="HS256")
+    if role:
+        payload["role"] = role
+    return jwt.encode(payload, secret, algorithm="HS256", headers={"kid": kid})
+
+
+# =============================================================================
+# QUERIES
+# =============================================================================
+
+# Every statement is PREPAREd once per warm connection and then only EXECUTEd:
+# Postgres parses and plans it once, values never end up in the SQL text.
+# name -> (parameter types, SQL with $n placeholders and {schema} prefix)
+STATEMENTS = {
+    "exchange_auth_token": ("text, text, timestamptz", """
+        WITH consumed AS (
+            UPDATE {schema}telegram_auth_tokens
+            SET used = TRUE
+            WHERE token_hash = $1 AND used = FALSE
+              AND expires_at > NOW() AND telegram_id <> ''
+            RETURNING telegram_id, telegram_username, telegram_first_name,
+                      telegram_last_name, telegram_photo_url
+        ), account AS (
+            INSERT INTO {schema}users (telegram_id, username, first_name, last_name, avatar_url,
+                                       email_verified, password_hash, last_login_at)
+            SELECT c.telegram_id,
+                   COALESCE(
+                       (SELECT v.candidate
+                        FROM (VALUES (1, c.telegram_username), (2, 'tg_' || c.telegram_id)) AS v(n, candidate)
+                        WHERE v.candidate IS NOT NULL
+                          AND NOT EXISTS (SELECT 1 FROM {schema}users u WHERE u.username = v.candidate)
+                        ORDER BY v.n LIMIT 1),
+                       'tg_' || c.telegram_id || '_' || substr(md5(random()::text), 1, 8)
+                   ),
+                   c.telegram_first_name, c.telegram_last_name, c.telegram_photo_url, TRUE, '', NOW()
+            FROM consumed c
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET first_name = COALESCE(EXCLUDED.first_name, users.first_name),
+                avatar_url = COALESCE(EXCLUDED.avatar_url, users.avatar_url),
+                last_login_at = NOW()
+            RETURNING id, email, first_name, last_name, avatar_url, telegram_id, session_generation
+        ), refresh AS (
+            INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at, generation)
+            SELECT id, $2, $3, session_generation FROM account
+        )
+        SELECT a.id, a.email, a.first_name, a.last_name, a.avatar_url, a.telegram_id,
+               a.session_generation, p.user_role
+        FROM account a
+        LEFT JOIN {schema}user_profiles p ON p.user_id = a.id
+    """),
+    "get_auth_token_state": ("text", """
+        SELECT expires_at <= NOW(), used, telegram_id
+        FROM {schema}telegram_auth_tokens
+        WHERE token_hash = $1
+    """),
+    # Refresh with rotation. A current token is marked rotated and replaced by
+    # a new one of the same family; a token that was already rotated is being
+    # reused (stolen or replayed), so its whole family is deleted. A token
+    # re-presented within $3 of its rotation is a benign replay (two tabs, a
+    # retried request) and keeps the family. Always returns exactly one row:
+    # the user for a rotation, the revoked count and how many tokens matched.
+    # The successor inherits expires_at: a family lives as long as the login
+    # that started it, and its rotated tokens are kept (for reuse detection)
+    # until then.
+    "rotate_refresh_token": ("text, text, interval", """
+        WITH presented AS (
+            SELECT rt.id, rt.family_id, rt.rotated_at
+            FROM {schema}refresh_tokens rt
+            JOIN {schema}users u ON u.id = rt.user_id AND u.session_generation = rt.generation
+            WHERE rt.token_hash = $1 AND rt.expires_at > NOW()
+        ), rotated AS (
+            UPDATE {schema}refresh_tokens rt
+            SET rotated_at = NOW()
+            FROM presented p
+            WHERE rt.id = p.id AND rt.rotated_at IS NULL
+            RETURNING rt.user_id, rt.family_id, rt.generation, rt.expires_at
+        ), issued AS (
+            INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at, generation, family_id)
+            SELECT user_id, $2, expires_at, generation, family_id FROM rotated
+        ), revoked AS (
+            DELETE FROM {schema}refresh_tokens rt
+            USING presented p
+            WHERE p.rotated_at < NOW() - $3 AND rt.family_id = p.family_id
+            RETURNING rt.id
+        )
+        SELECT u.id, u.email, u.first_name, u.last_name, u.avatar_url, u.telegram_id,
+               u.session_generation, pr.user_role,
+               (SELECT COUNT(*) FROM revoked), (SELECT COUNT(*) FROM presented)
+        FROM (SELECT 1) AS one
+        LEFT JOIN rotated r ON TRUE
+        LEFT JOIN {schema}users u ON u.id = r.user_id
+        LEFT JOIN {schema}user_profiles pr ON pr.user_id = u.id
+    """),
+    "delete_refresh_family": ("text", """
+        DELETE FROM {schema}refresh_tokens
+        WHERE family_id = (SELECT family_id FROM {schema}refresh_tokens WHERE token_hash = $1)
+    """),
+    "revoke_sessions": ("text", """
+        UPDATE {schema}users u
+        SET session_generation = u.session_generation + 1,
+            session_generation_changed_at = NOW()
+        FROM {schema}refresh_tokens rt
+        WHERE rt.token_hash = $1 AND rt.expires_at > NOW() AND rt.rotated_at IS NULL
+          AND u.id = rt.user_id AND u.session_generation = rt.generation
+    """),
+    # Reaper: each statement removes at most one batch found through an index
+    "reap_auth_tokens_expired": ("integer", """
+        DELETE FROM {schema}telegram_auth_tokens WHERE id IN (
+            SELECT id FROM {schema}telegram_auth_tokens
+            WHERE expires_at < NOW() LIMIT $1
+        )
+    """),
+    "reap_auth_tokens_used": ("integer", """
+        DELETE FROM {schema}telegram_auth_tokens WHERE id IN (
+            SELECT id FROM {schema}telegram_auth_tokens
+            WHERE used = TRUE AND created_at < NOW() - INTERVAL '1 hour' LIMIT $1
+        )
+    """),
+    "reap_refresh_tokens_expired": ("integer", """
+        DELETE FROM {schema}refresh_tokens WHERE id IN (
+            SELECT id FROM {schema}refresh_tokens
+            WHERE expires_at < NOW() LIMIT $1
+        )
+    """),
+}
+
+# Prepared statements live as long as the connection they were prepared on
+_prepared_conn = None
+_prepared = set()
+QUERY_STATS = {"prepared": 0, "executed": 0}
+
+
+def run_query(cursor, name: str, *params) -> None:
+    """EXECUTE a named statement, PREPAREing it on first use on this connection."""
+    global _prepared_conn
+
+    if cursor.connection is not _prepared_conn:
+        _prepared_conn = cursor.connection
+        _prepared.clear()
+
+    if name not in _prepared:
+        types, sql = STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({types}) AS {sql.format(schema=get_schema())}")
+        _prepared.add(name)
+        QUERY_STATS["prepared"] += 1
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    QUERY_STATS["executed"] += 1
 
 
 # =============================================================================
 # DATABASE OPERATIONS
 # =============================================================================
 
-def get_auth_token(cursor, token: str) -> Optional[dict]:
-    """Get auth token data by token."""
-    token_hash = hash_token(token)
-    schema = get_schema()
+EXCHANGE_ATTEMPTS = 3
 
-    cursor.execute(f"""
-        SELECT telegram_id, telegram_username, telegram_first_name,
-               telegram_last_name, telegram_photo_url, expires_at, used
-        FROM {schema}telegram_auth_tokens
-        WHERE token_hash = '{token_hash}'
-    """)
+
+def exchange_auth_token(
+    cursor, token_hash: str, refresh_hash: str, refresh_expires: datetime
+) -> Optional[dict]:
+    """
+    Consume an auth token, upsert its Telegram user and store the refresh hash
+    in one atomic statement. None if the token is unknown, expired or used:
+    of two concurrent callbacks only the first one consumes the token.
+
+    A new user gets the first free name of: Telegram username, tg_<id>,
+    tg_<id>_<random>. If a concurrent signup takes that name before commit,
+    the failed statement has changed nothing (autocommit) and is repeated;
+    the taken name is then visible and skipped.
+    """
+    for attempt in range(EXCHANGE_ATTEMPTS):
+        try:
+            run_query(cursor, "exchange_auth_token", token_hash, refresh_hash, refresh_expires)
+            break
+        except psycopg2.errors.UniqueViolation:
+            if attempt == EXCHANGE_ATTEMPTS - 1:
+                raise
 
     row = cursor.fetchone()
     if not row:
         return None
-
     return {
-        "telegram_id": row[0],
-        "telegram_username": row[1],
-        "telegram_first_name": row[2],
-        "telegram_last_name": row[3],
-        "telegram_photo_url": row[4],
-        "expires_at": row[5],
-        "used": row[6],
+        "user": {
+            "id": row[0],
+            "email": row[1],
+            "name": f"{row[2] or ''} {row[3] or ''}".strip(),
+            "avatar_url": row[4],
+            "telegram_id": row[5],
+        },
+        "generation": row[6],
+        "role": row[7],
     }
 
 
-def mark_token_used(cursor, token: str) -> bool:
-    """Mark token as used."""
-    token_hash = hash_token(token)
-    schema = get_schema()
-
-    cursor.execute(f"""
-        UPDATE {schema}telegram_auth_tokens
-        SET used = TRUE
-        WHERE token_hash = '{token_hash}' AND used = FALSE
-        RETURNING id
-    """)
+def get_auth_token_state(cursor, token_hash: str) -> Optional[dict]:
+    """Why a token could not be exchanged: only read on the failure path."""
+    run_query(cursor, "get_auth_token_state", token_hash)
 
-    return cursor.fetchone() is not None
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {"expired": row[0], "used": row[1], "telegram_id": row[2]}
 
 
-def cleanup_expired_tokens(cursor) -> None:
-    """Remove expired auth tokens."""
-    schema = get_schema()
-    cursor.execute(f"""
-        DELETE FROM {schema}telegram_auth_tokens
-        WHERE expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')
-    """)
+# Replays of a just-rotated token are not treated as reuse
+REFRESH_REUSE_GRACE = timedelta(seconds=int(os.environ.get("REFRESH_REUSE_GRACE", "10")))
 
 
-def find_user_by_telegram_id(cursor, telegram_id: str) -> Optional[dict]:
-    """Find user by Telegram ID."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT id, email, first_name, last_name, avatar_url, telegram_id
-        FROM {schema}users
-        WHERE telegram_id = '{telegram_id}'
-    """)
+def rotate_refresh_token(cursor, token_hash: str, new_hash: str) -> Optional[dict]:
+    """
+    Swap a refresh token for a new one of the same family and return the user
+    in one statement. None if the token is unknown, expired or revoked;
+    {"replayed": True} if it was rotated moments ago (another tab or a retry
+    got there first). Reuse of a rotated token after REFRESH_REUSE_GRACE
+    deletes its whole family.
+    """
+    run_query(cursor, "rotate_refresh_token", token_hash, new_hash, REFRESH_REUSE_GRACE)
 
     row = cursor.fetchone()
-    if row:
-        name = f"{row[2] or ''} {row[3] or ''}".strip()
-        return {
+    if row[8]:
+        print(f"Refresh token reuse detected, revoked {row[8]} tokens of the family")
+        return None
+    if row[0] is None:
+        return {"replayed": True} if row[9] else None
+    return {
+        "user": {
             "id": row[0],
             "email": row[1],
-            "name": name,
+            "name": f"{row[2] or ''} {row[3] or ''}".strip(),
             "avatar_url": row[4],
             "telegram_id": row[5],
-        }
-    return None
-
-
-def create_or_update_user(
-    cursor,
-    telegram_id: str,
-    username: Optional[str],
-    first_name: Optional[str],
-    last_name: Optional[str],
-    photo_url: Optional[str]
-) -> dict:
-    """Create new user or update existing one."""
-    schema = get_schema()
-
-    # Build display name
-    name_parts = []
-    if first_name:
-        name_parts.append(first_name)
-    if last_name:
-        name_parts.append(last_name)
-    display_name = " ".join(name_parts) if name_parts else username or f"User {telegram_id}"
-
-    # Check if user exists
-    existing = find_user_by_telegram_id(cursor, telegram_id)
-
-    if existing:
-        # Update existing user
-        first_name_str = f"'{first_name}'" if first_name else "first_name"
-        photo_url_str = f"'{photo_url}'" if photo_url else "avatar_url"
-        cursor.execute(f"""
-            UPDATE {schema}users
-            SET first_name = COALESCE({first_name_str}, first_name),
-                avatar_url = COALESCE({photo_url_str}, avatar_url),
-                last_login_at = NOW()
-            WHERE telegram_id = '{telegram_id}'
-            RETURNING id, email, first_name, last_name, avatar_url, telegram_id
-        """)
-    else:
-        # Create new user with username
-        username_val = username or f"tg_{telegram_id}"
-        first_name_str = f"'{first_name}'" if first_name else "NULL"
-        last_name_str = f"'{last_name}'" if last_name else "NULL"
-        photo_url_str = f"'{photo_url}'" if photo_url else "NULL"
-        cursor.execute(f"""
-            INSERT INTO {schema}users (telegram_id, username, first_name, last_name, avatar_url, email_verified, password_hash, last_login_at)
-            VALUES ('{telegram_id}', '{username_val}', {first_name_str}, {last_name_str}, {photo_url_str}, TRUE, '', NOW())
-            RETURNING id, email, first_name, last_name, avatar_url, telegram_id
-        """)
-
-    row = cursor.fetchone()
-    name = f"{row[2] or ''} {row[3] or ''}".strip()
-    return {
-        "id": row[0],
-        "email": row[1],
-        "name": name,
-        "avatar_url": row[4],
-        "telegram_id": row[5],
+        },
+        "generation": row[6],
+        "role": row[7],
     }
 
 
-def save_refresh_token(cursor, user_id: int, token_hash: str, expires_at: datetime) -> None:
-    """Save hashed refresh token to DB."""
-    schema = get_schema()
-    expires_str = expires_at.isoformat()
-    cursor.execute(f"""
-        INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at)
-        VALUES ({user_id}, '{token_hash}', '{expires_str}')
-    """)
+def delete_refresh_family(cursor, token_hash: str) -> None:
+    """Delete the refresh token together with the rest of its family."""
+    run_query(cursor, "delete_refresh_family", token_hash)
 
 
-def find_refresh_token(cursor, token_hash: str) -> Optional[dict]:
-    """Find refresh token by hash."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT user_id, expires_at
-        FROM {schema}refresh_tokens
-        WHERE token_hash = '{token_hash}' AND expires_at > NOW()
-    """)
+def revoke_sessions(cursor, token_hash: str) -> bool:
+    """Bump the session generation of the refresh token owner."""
+    run_query(cursor, "revoke_sessions", token_hash)
+    return cursor.rowcount > 0
 
-    row = cursor.fetchone()
-    if row:
-        return {"user_id": row[0], "expires_at": row[1]}
-    return None
 
+# =============================================================================
+# REAPER
+# =============================================================================
 
-def delete_refresh_token(cursor, token_hash: str) -> None:
-    """Delete refresh token."""
-    schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE token_hash = '{token_hash}'")
+REAPER_BATCH_SIZE = int(os.environ.get("REAPER_BATCH_SIZE", "500"))
+REAPER_TIME_BUDGET = float(os.environ.get("REAPER_TIME_BUDGET", "20"))
 
+# With autocommit every batch is its own short transaction
+REAP_KINDS = ("auth_tokens_expired", "auth_tokens_used", "refresh_tokens_expired")
 
-def get_user_by_id(cursor, user_id: int) -> Optional[dict]:
-    """Get user by ID."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT id, email, name, avatar_url, telegram_id
-        FROM {schema}users WHERE id = {user_id}
-    """)
 
-    row = cursor.fetchone()
-    if row:
-        return {
-            "id": row[0],
-            "email": row[1],
-            "name": row[2],
-            "avatar_url": row[3],
-            "telegram_id": row[4],
-        }
-    return None
+def is_timer_event(event: dict) -> bool:
+    """Invocation by a timer trigger rather than over HTTP."""
+    messages = event.get("messages") or []
+    return bool(messages) and all(
+        message.get("event_metadata", {}).get("event_type", "").endswith("TimerMessage")
+        for message in messages
+    )
 
 
-def cleanup_expired_refresh_tokens(cursor) -> None:
-    """Remove expired refresh tokens."""
-    schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE expires_at < NOW()")
+def reap_expired_tokens(cursor) -> dict:
+    """Delete expired and used tokens in bounded batches, report rows and time."""
+    started = time.monotonic()
+    report = {"batches": 0}
+
+    for kind in REAP_KINDS:
+        report[kind] = 0
+        while time.monotonic() - started < REAPER_TIME_BUDGET:
+            run_query(cursor, f"reap_{kind}", REAPER_BATCH_SIZE)
+            report[kind] += cursor.rowcount
+            report["batches"] += 1
+            if cursor.rowcount < REAPER_BATCH_SIZE:
+                break
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    print(f"Reaper: {json.dumps(report)}")
+    return report
 
 
 # =============================================================================
@@ -262,7 +440,7 @@ def get_cors_headers() -> dict:
     allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*")
     return {
         "Access-Control-Allow-Origin": allowed_origins,
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
         "Access-Control-Allow-Headers": "Content-Type",
     }
 
@@ -285,6 +463,14 @@ def options_response() -> dict:
     }
 
 
+def metrics_allowed(event: dict) -> bool:
+    """Counters are only served with an X-Metrics-Token header equal to METRICS_TOKEN."""
+    expected = os.environ.get("METRICS_TOKEN", "")
+    provided = next((value or "" for key, value in (event.get("headers") or {}).items()
+                     if key.lower() == "x-metrics-token"), "")
+    return bool(expected) and hmac.compare_digest(provided.encode(), expected.encode())
+
+
 # =============================================================================
 # ACTION HANDLERS
 # =============================================================================
@@ -299,53 +485,31 @@ def handle_callback(cursor, body: dict) -> dict:
     if not token:
         return cors_response(400, {"error": "Missing token"})
 
-    token_data = get_auth_token(cursor, token)
-
-    if not token_data:
-        return cors_response(404, {"error": "Token not found"})
-
-    # Check if expired (handle both naive and aware datetime from DB)
-    expires_at = token_data["expires_at"]
-    now = datetime.now(timezone.utc)
-    # Convert to naive UTC for comparison if needed
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < now:
-        return cors_response(410, {"error": "Token expired"})
-
-    # Check if already used
-    if token_data["used"]:
-        return cors_response(410, {"error": "Token already used"})
-
-    # Check if user data exists
-    if not token_data["telegram_id"]:
-        return cors_response(400, {"error": "Token not authenticated"})
-
-    # Get JWT secret
-    jwt_secret = get_env("JWT_SECRET")
+    # Get JWT signing key before the token is consumed
+    kid, jwt_secret = get_signing_key()
     if len(jwt_secret) < 32:
         return cors_response(500, {"error": "Server configuration error"})
 
-    # Create or update user
-    user = create_or_update_user(
-        cursor,
-        telegram_id=token_data["telegram_id"],
-        username=token_data["telegram_username"],
-        first_name=token_data["telegram_first_name"],
-        last_name=token_data["telegram_last_name"],
-        photo_url=token_data["telegram_photo_url"],
-    )
-
-    # Mark token as used
-    mark_token_used(cursor, token)
-
-    # Generate tokens
-    access_token = create_jwt(user["id"], jwt_secret)
+    token_hash = hash_token(token)
     refresh_token = generate_token(48)
-    refresh_token_hash = hash_token(refresh_token)
     refresh_expires = datetime.now(timezone.utc) + timedelta(days=30)
 
-    save_refresh_token(cursor, user["id"], refresh_token_hash, refresh_expires)
+    exchanged = exchange_auth_token(cursor, token_hash, hash_token(refresh_token), refresh_expires)
+
+    if not exchanged:
+        state = get_auth_token_state(cursor, token_hash)
+        if not state:
+            return cors_response(404, {"error": "Token not found"})
+        if state["used"]:
+            return cors_response(410, {"error": "Token already used"})
+        if state["expired"]:
+            return cors_response(410, {"error": "Token expired"})
+        return cors_response(400, {"error": "Token not authenticated"})
+
+    user = exchanged["user"]
+    access_token = create_jwt(
+        user["id"], jwt_secret, role=exchanged["role"], kid=kid, generation=exchanged["generation"]
+    )
 
     return cors_response(200, {
         "access_token": access_token,
@@ -358,28 +522,33 @@ def handle_callback(cursor, body: dict) -> dict:
 def handle_refresh(cursor, body: dict) -> dict:
     """
     POST ?action=refresh
-    Refresh access token using refresh token.
+    Refresh access token and rotate the refresh token.
     """
     refresh_token = body.get("refresh_token")
     if not refresh_token:
         return cors_response(400, {"error": "Missing refresh_token"})
 
-    jwt_secret = get_env("JWT_SECRET")
+    kid, jwt_secret = get_signing_key()
     token_hash = hash_token(refresh_token)
 
-    token_data = find_refresh_token(cursor, token_hash)
-    if not token_data:
-        return cors_response(401, {"error": "Invalid or expired refresh token"})
-
-    user = get_user_by_id(cursor, token_data["user_id"])
-    if not user:
-        return cors_response(401, {"error": "User not found"})
+    new_refresh_token = generate_token(48)
 
-    # Generate new access token
-    access_token = create_jwt(user["id"], jwt_secret)
+    rotated = rotate_refresh_token(cursor, token_hash, hash_token(new_refresh_token))
+    if not rotated:
+        return cors_response(401, {"error": "Invalid or expired refresh token"})
+    if rotated.get("replayed"):
+        # The family is intact: the client must pick up the successor token
+        # instead of treating this as a logout
+        return cors_response(409, {"error": "Refresh token already rotated"})
+
+    user = rotated["user"]
+    access_token = create_jwt(
+        user["id"], jwt_secret, role=rotated["role"], kid=kid, generation=rotated["generation"]
+    )
 
     return cors_response(200, {
         "access_token": access_token,
+        "refresh_token": new_refresh_token,
         "expires_in": 900,
         "user": user,
     })
@@ -393,7 +562,22 @@ def handle_logout(cursor, body: dict) -> dict:
     refresh_token = body.get("refresh_token")
     if refresh_token:
         token_hash = hash_token(refresh_token)
-        delete_refresh_token(cursor, token_hash)
+        delete_refresh_family(cursor, token_hash)
+
+    return cors_response(200, {"success": True})
+
+
+def handle_logout_all(cursor, body: dict) -> dict:
+    """
+    POST ?action=logout_all
+    Invalidate every refresh and access token of the user at once.
+    """
+    refresh_token = body.get("refresh_token")
+    if not refresh_token:
+        return cors_response(400, {"error": "Missing refresh_token"})
+
+    if not revoke_sessions(cursor, hash_token(refresh_token)):
+        return cors_response(401, {"error": "Invalid or expired refresh token"})
 
     return cors_response(200, {"success": True})
 
@@ -403,7 +587,15 @@ def handle_logout(cursor, body: dict) -> dict:
 # =============================================================================
 
 def handler(event, context):
-    """Main entry point."""
+    """Main entry point. A timer trigger invocation runs the token reaper."""
+    if is_timer_event(event):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                return {"statusCode": 200, "body": json.dumps(reap_expired_tokens(cursor))}
+        finally:
+            release_db_connection(conn)
+
     method = event.get("httpMethod", "GET")
 
     # Handle CORS preflight
@@ -414,6 +606,11 @@ def handler(event, context):
     params = event.get("queryStringParameters") or {}
     action = params.get("action", "")
 
+    if action == "metrics" and method == "GET":
+        if not metrics_allowed(event):
+            return cors_response(403, {"error": "Forbidden"})
+        return cors_response(200, {"db": DB_STATS, "queries": QUERY_STATS})
+
     # Parse body for POST requests
     body = {}
     if method == "POST":
@@ -428,10 +625,6 @@ def handler(event, context):
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Cleanup expired tokens periodically
-        cleanup_expired_tokens(cursor)
-        cleanup_expired_refresh_tokens(cursor)
-
         # Route to action handler
         if action == "callback" and method == "POST":
             response = handle_callback(cursor, body)
@@ -439,6 +632,8 @@ def handler(event, context):
             response = handle_refresh(cursor, body)
         elif action == "logout" and method == "POST":
             response = handle_logout(cursor, body)
+        elif action == "logout_all" and method == "POST":
+            response = handle_logout_all(cursor, body)
         else:
             response = cors_response(400, {"error": f"Unknown action: {action}"})
 
@@ -454,4 +649,4 @@ def handler(event, context):
         return cors_response(500, {"error": "Internal server error", "details": str(e)})
     finally:
         if conn:
-            conn.close()
\ No newline at end of file
+            release_db_connection(conn)
\ No newline at end of file
@@ -11,6 +11,8 @@ import json
 import os
 import uuid
 import hashlib
+import hmac
+import time
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
@@ -46,6 +48,60 @@ def get_schema() -> str:
     return f"{schema}." if schema else ""
 
 
+DB_PING_INTERVAL = 30
+
+# Warm containers keep the connection between invocations
+_db_conn = None
+_db_last_used = 0.0
+DB_STATS = {"connects": 0, "reuses": 0, "reconnects": 0}
+
+
+def ping_connection(conn) -> bool:
+    """Cheap liveness check for a cached connection."""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_db_connection():
+    """Return the warm connection from a previous invocation or open a new one."""
+    global _db_conn
+
+    conn = _db_conn
+    if conn is not None and not conn.closed:
+        if time.monotonic() - _db_last_used < DB_PING_INTERVAL or ping_connection(conn):
+            DB_STATS["reuses"] += 1
+            return conn
+        DB_STATS["reconnects"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    conn.autocommit = True
+    _db_conn = conn
+    DB_STATS["connects"] += 1
+    return conn
+
+
+def release_db_connection(conn) -> None:
+    """End of invocation: reset transaction state but keep the connection open."""
+    global _db_last_used
+
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        _db_last_used = time.monotonic()
+    except psycopg2.Error:
+        conn.close()
+
+
 # =============================================================================
 # CORS HELPERS
 # =============================================================================
@@ -54,7 +110,7 @@ def get_cors_headers() -> dict:
     allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*")
     return {
         "Access-Control-Allow-Origin": allowed_origins,
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
         "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Bot-Api-Secret-Token",
     }
 
@@ -75,6 +131,55 @@ def options_response() -> dict:
     }
 
 
+def metrics_allowed(event: dict) -> bool:
+    """Counters are only served with an X-Metrics-Token header equal to METRICS_TOKEN."""
+    expected = os.environ.get("METRICS_TOKEN", "")
+    provided = next((value or "" for key, value in (event.get("headers") or {}).items()
+                     if key.lower() == "x-metrics-token"), "")
+    return bool(expected) and hmac.compare_digest(provided.encode(), expected.encode())
+
+
+# =============================================================================
+# QUERIES
+# =============================================================================
+
+# Every statement is PREPAREd once per warm connection and then only EXECUTEd:
+# Postgres parses and plans it once, values never end up in the SQL text.
+# name -> (parameter types, SQL with $n placeholders and {schema} prefix)
+STATEMENTS = {
+    "save_auth_token": ("text, text, text, text, text, timestamptz", """
+        INSERT INTO {schema}telegram_auth_tokens
+        (token_hash, telegram_id, telegram_username, telegram_first_name,
+         telegram_last_name, telegram_photo_url, expires_at)
+        VALUES ($1, $2, $3, $4, $5, NULL, $6)
+    """),
+}
+
+# Prepared statements live as long as the connection they were prepared on
+_prepared_conn = None
+_prepared = set()
+QUERY_STATS = {"prepared": 0, "executed": 0}
+
+
+def run_query(cursor, name: str, *params) -> None:
+    """EXECUTE a named statement, PREPAREing it on first use on this connection."""
+    global _prepared_conn
+
+    if cursor.connection is not _prepared_conn:
+        _prepared_conn = cursor.connection
+        _prepared.clear()
+
+    if name not in _prepared:
+        types, sql = STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({types}) AS {sql.format(schema=get_schema())}")
+        _prepared.add(name)
+        QUERY_STATS["prepared"] += 1
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    QUERY_STATS["executed"] += 1
+
+
 # =============================================================================
 # DATABASE OPERATIONS
 # =============================================================================
@@ -88,26 +193,17 @@ def save_auth_token(
     """Сохраняет токен авторизации в БД и возвращает его."""
     token = str(uuid.uuid4())
     token_hash = hashlib.sha256(token.encode()).hexdigest()
-    schema = get_schema()
-    
-    # Format data for SQL string
-    username_str = f"'{username}'" if username else "NULL"
-    first_name_str = f"'{first_name}'" if first_name else "NULL"
-    last_name_str = f"'{last_name}'" if last_name else "NULL"
-    expires_at = (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=5)
 
-    conn = psycopg2.connect(os.environ["DATABASE_URL"])
-    conn.autocommit = True
+    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute(f"""
-            INSERT INTO {schema}telegram_auth_tokens
-            (token_hash, telegram_id, telegram_username, telegram_first_name,
-             telegram_last_name, telegram_photo_url, expires_at)
-            VALUES ('{token_hash}', '{telegram_id}', {username_str}, {first_name_str}, {last_name_str}, NULL, '{expires_at}')
-        """)
+        with conn.cursor() as cursor:
+            run_query(
+                cursor, "save_auth_token",
+                token_hash, telegram_id, username or None, first_name or None, last_name or None, expires_at
+            )
     finally:
-        conn.close()
+        release_db_connection(conn)
 
     return token
 
@@ -116,7 +212,40 @@ def save_auth_token(
 # WEBHOOK HANDLERS (Authorization)
 # =============================================================================
 
-def handle_web_auth(chat_id: int, user: dict) -> None:
+def send_message_reply(chat_id: int, text: str, reply_markup: Optional[dict] = None) -> dict:
+    """sendMessage call in the form Telegram accepts as a webhook response body."""
+    reply = {"method": "sendMessage", "chat_id": chat_id, "text": text}
+    if reply_markup:
+        reply["reply_markup"] = reply_markup
+    return reply
+
+
+def webhook_response(replies: list) -> dict:
+    """
+    Answer the webhook. The last reply goes back in the response body, so a
+    single reply needs no outbound request; earlier ones are sent through the
+    Bot API first to keep their order.
+    """
+    if not replies:
+        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+
+    bot = None
+    for reply in replies[:-1]:
+        bot = bot or get_bot()
+        markup = reply.get("reply_markup")
+        bot.send_message(
+            reply["chat_id"], reply["text"],
+            reply_markup=json.dumps(markup) if markup else None
+        )
+
+    return {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(replies[-1]),
+    }
+
+
+def handle_web_auth(chat_id: int, user: dict) -> list:
     """Обработка команды /start web_auth."""
     telegram_id = str(user.get("id", ""))
     username = user.get("username")
@@ -128,20 +257,16 @@ def handle_web_auth(chat_id: int, user: dict) -> None:
     site_url = os.environ["SITE_URL"].rstrip("/")
     auth_url = f"{site_url}/auth/telegram/callback?token={token}"
 
-    bot = get_bot()
-    bot.send_message(
+    return [send_message_reply(
         chat_id,
-        f"Авторизация готова!\n\nНажмите кнопку ниже, чтобы войти на сайт 👇\n\nСсылка действительна 5 минут.",
-        reply_markup=telebot.types.InlineKeyboardMarkup().add(
-            telebot.types.InlineKeyboardButton("Войти на сайт", url=auth_url)
-        )
-    )
+        "Авторизация готова!\n\nНажмите кнопку ниже, чтобы войти на сайт 👇\n\nСсылка действительна 5 минут.",
+        reply_markup={"inline_keyboard": [[{"text": "Войти на сайт", "url": auth_url}]]}
+    )]
 
 
-def handle_start(chat_id: int) -> None:
+def handle_start(chat_id: int) -> list:
     """Обработка команды /start без параметров."""
-    bot = get_bot()
-    bot.send_message(chat_id, "Привет! Используйте кнопку «Войти через Telegram» на сайте.")
+    return [send_message_reply(chat_id, "Привет! Используйте кнопку «Войти через Telegram» на сайте.")]
 
 
 def process_webhook(body: dict) -> dict:
@@ -149,28 +274,30 @@ def process_webhook(body: dict) -> dict:
     message = body.get("message")
 
     if not message:
-        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+        return webhook_response([])
 
     text = message.get("text", "")
     user = message.get("from", {})
     chat_id = message.get("chat", {}).get("id")
 
     if not chat_id:
-        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+        return webhook_response([])
 
     try:
+        replies = []
         if text.startswith("/start"):
             parts = text.split(" ", 1)
             if len(parts) > 1 and parts[1] == "web_auth":
-                handle_web_auth(chat_id, user)
+                replies = handle_web_auth(chat_id, user)
             else:
-                handle_start(chat_id)
+                replies = handle_start(chat_id)
+        return webhook_response(replies)
     except telebot.apihelper.ApiTelegramException as e:
         print(f"Telegram API error: {e}")
     except Exception as e:
         print(f"Error processing webhook: {e}")
 
-    return {"statusCode": 200, "body": json.dumps({"ok": True})}
+    return webhook_response([])
 
 
 # =============================================================================
@@ -322,6 +449,10 @@ def handler(event: dict, context) -> dict:
             return handle_send_photo(body)
         elif action == "test" and method == "POST":
             return handle_test(body)
+        elif action == "metrics" and method == "GET":
+            if not metrics_allowed(event):
+                return cors_response(403, {"error": "Forbidden"})
+            return cors_response(200, {"db": DB_STATS, "queries": QUERY_STATS})
         else:
             return cors_response(400, {"error": f"Unknown action: {action}"})
 
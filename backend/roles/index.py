@@ -1,7 +1,330 @@
+import hashlib
+import hmac
 import json
 import os
+import jwt
 import psycopg2
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+DB_PING_INTERVAL = 30
+
+# Списки заявок собираются в JSON самим PostgreSQL и отдаются без разбора;
+# SQL_JSON=0 возвращает сборку словарей в Python (для сравнения)
+SQL_JSON = os.environ.get('SQL_JSON', '1') != '0'
+
+# Соединение переживает вызов и переиспользуется тёплым контейнером
+_db_conn = None
+_db_last_used = 0.0
+DB_STATS = {'connects': 0, 'reuses': 0, 'reconnects': 0}
+
+def ping_connection(conn) -> bool:
+    '''Дешёвая проверка живости соединения'''
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        if not conn.autocommit:
+            conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Соединение с БД: тёплое из прошлого вызова или новое'''
+    global _db_conn
+    
+    conn = _db_conn
+    if conn is not None and not conn.closed:
+        if time.monotonic() - _db_last_used < DB_PING_INTERVAL or ping_connection(conn):
+            DB_STATS['reuses'] += 1
+            return conn
+        DB_STATS['reconnects'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    _db_conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    DB_STATS['connects'] += 1
+    return _db_conn
+
+def release_db_connection(conn) -> None:
+    '''Конец вызова: сбрасываем незавершённую транзакцию, дописываем продления сессий,
+    соединение не закрываем'''
+    global _db_last_used
+    
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        flush_session_extensions(conn)
+        _db_last_used = time.monotonic()
+    except psycopg2.Error:
+        conn.close()
+
+SESSION_CACHE_SIZE = 1024
+SESSION_CACHE_TTL = 60
+SESSION_NEGATIVE_TTL = 10
+
+# token -> (момент записи, сессия или None); порядок ключей = порядок использования
+_session_cache = OrderedDict()
+SESSION_STATS = {'hits': 0, 'misses': 0, 'jwt': 0, 'extended': 0, 'revoked': 0}
+
+def cache_session(token: str, session) -> None:
+    '''Запоминает сессию (или её отсутствие) для токена'''
+    _session_cache[token] = (time.monotonic(), session)
+    _session_cache.move_to_end(token)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+
+def cached_session(token: str) -> tuple:
+    '''(найдено в кеше, сессия или None) без обращения к БД'''
+    entry = _session_cache.get(token)
+    if entry is None:
+        return False, None
+    
+    stored_at, session = entry
+    ttl = SESSION_CACHE_TTL if session else SESSION_NEGATIVE_TTL
+    if time.monotonic() - stored_at >= ttl or (session and session['expires_at'] <= datetime.now()):
+        del _session_cache[token]
+        return False, None
+    
+    _session_cache.move_to_end(token)
+    return True, session
+
+# JWT_KEYS='{"kid": "секрет", ...}' держит текущий и предыдущие ключи на время ротации,
+# JWT_SECRET — одиночный ключ с kid "default"
+_jwt_keys = None
+
+def get_jwt_keys() -> dict:
+    '''Ключи подписи access-токенов: kid -> секрет'''
+    global _jwt_keys
+    
+    if _jwt_keys is None:
+        keys = json.loads(os.environ.get('JWT_KEYS') or '{}')
+        if os.environ.get('JWT_SECRET'):
+            keys.setdefault('default', os.environ['JWT_SECRET'])
+        _jwt_keys = keys
+    return _jwt_keys
+
+def verify_access_token(token: str):
+    '''Сессия из claims подписанного JWT или None, без обращения к БД'''
+    keys = get_jwt_keys()
+    try:
+        kid = jwt.get_unverified_header(token).get('kid', 'default')
+        if kid not in keys:
+            return None
+        claims = jwt.decode(token, keys[kid], algorithms=['HS256'], options={'require': ['exp', 'user_id']})
+    except jwt.InvalidTokenError:
+        return None
+    
+    return {
+        'user_id': claims['user_id'],
+        'role': claims.get('role'),
+        'expires_at': datetime.fromtimestamp(claims['exp']),
+        'generation': claims.get('gen', 0)
+    }
+
+def is_jwt(token: str) -> bool:
+    '''Непрозрачные токены сессий не содержат точек, JWT — ровно две'''
+    return token.count('.') == 2
+
+def token_digest(token: str) -> bytes:
+    '''В user_sessions хранится SHA-256 токена, а не сам токен'''
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+# Непрозрачный токен: сессия живого поколения с ролью пользователя
+SESSION_SQL = """
+    SELECT s.user_id, p.user_role, s.expires_at, s.generation
+    FROM user_sessions s
+    JOIN users u ON u.id = s.user_id AND u.session_generation = s.generation
+    LEFT JOIN user_profiles p ON p.user_id = s.user_id
+    WHERE s.token_hash = %s AND s.expires_at > NOW()
+"""
+
+def resolve_session(cur, token: str):
+    '''Сессия по токену: {'user_id', 'role', 'expires_at', 'generation'} или None.
+    
+    JWT проверяется локально по подписи, непрозрачный токен — одним запросом к БД.
+    Токены отозванного поколения (action=logout_all в auth) не принимаются.
+    '''
+    if is_jwt(token):
+        SESSION_STATS['jwt'] += 1
+        session = verify_access_token(token)
+        return None if session is None or is_revoked(cur, session) else session
+    
+    # Опрос до кеша: сессии пользователей, вышедших в других контейнерах, из него уже убраны
+    poll_generations(cur)
+    hit, session = cached_session(token)
+    if hit:
+        SESSION_STATS['hits'] += 1
+        if session is not None and is_revoked(cur, session):
+            cache_session(token, None)
+            return None
+        touch_session(token, session)
+        return session
+    
+    SESSION_STATS['misses'] += 1
+    cur.execute(SESSION_SQL, (token_digest(token),))
+    row = cur.fetchone()
+    session = {'user_id': row[0], 'role': row[1], 'expires_at': row[2], 'generation': row[3]} if row else None
+    cache_session(token, session)
+    touch_session(token, session)
+    return session
+
+# Поколение сессий пользователя: auth?action=logout_all увеличивает users.session_generation.
+# Контейнер не чаще раза в GENERATION_POLL_INTERVAL забирает недавно изменённые поколения,
+# по ним отклоняются JWT и сессии из кеша; при холодном старте — изменения за
+# GENERATION_LOOKBACK, что дольше жизни JWT и записей кеша. Обычный выход в auth
+# обновляет только session_generation_changed_at: сессии такого пользователя
+# удаляются из кеша и при следующем запросе перепроверяются в user_sessions
+GENERATION_POLL_INTERVAL = 5
+GENERATION_OVERLAP = timedelta(seconds=10)
+GENERATION_LOOKBACK = timedelta(hours=1)
+_generations = {}
+_session_stamps = {}
+_generations_since = None
+_generations_polled_at = 0.0
+
+def poll_generations(cur) -> None:
+    '''Подтягивает поколения, изменённые с прошлого опроса'''
+    global _generations_since, _generations_polled_at
+    
+    if _generations_since is not None and time.monotonic() - _generations_polled_at < GENERATION_POLL_INTERVAL:
+        return
+    
+    # Отметка опроса берётся с часов БД: ими же проставлен session_generation_changed_at
+    cur.execute(
+        """SELECT LOCALTIMESTAMP, u.id, u.session_generation, u.session_generation_changed_at
+           FROM (SELECT 1) AS one
+           LEFT JOIN users u
+             ON u.session_generation_changed_at > COALESCE(%s::timestamp - %s, LOCALTIMESTAMP - %s)""",
+        (_generations_since, GENERATION_OVERLAP, GENERATION_LOOKBACK)
+    )
+    changed = set()
+    for polled_at, user_id, generation, changed_at in cur.fetchall():
+        if user_id is None:
+            continue
+        _generations[user_id] = max(generation, _generations.get(user_id, 0))
+        if user_id not in _session_stamps or changed_at > _session_stamps[user_id]:
+            _session_stamps[user_id] = changed_at
+            changed.add(user_id)
+    if changed:
+        for token, (_, session) in list(_session_cache.items()):
+            if session and session['user_id'] in changed:
+                del _session_cache[token]
+    _generations_since = polled_at
+    _generations_polled_at = time.monotonic()
+
+def is_revoked(cur, session: dict) -> bool:
+    poll_generations(cur)
+    if session['generation'] < _generations.get(session['user_id'], 0):
+        SESSION_STATS['revoked'] += 1
+        return True
+    return False
+
+# Скользящий срок сессии: продление не чаще раза в SESSION_EXTEND_INTERVAL на токен.
+# Момент прошлого продления виден по expires_at (оно всегда равно продлению + SESSION_TTL),
+# продления копятся в памяти и записываются одним UPDATE при освобождении соединения
+SESSION_TTL = timedelta(days=30)
+SESSION_EXTEND_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_EXTEND_INTERVAL', '3600')))
+SESSION_FLUSH_INTERVAL = 30
+SESSION_FLUSH_BATCH = 100
+_pending_extensions = set()
+_pending_since = 0.0
+
+def touch_session(token: str, session) -> None:
+    '''Ставит непрозрачную сессию в очередь на продление, если подошёл её срок'''
+    global _pending_since
+    
+    if session is None:
+        return
+    extended = datetime.now() + SESSION_TTL
+    if extended - session['expires_at'] < SESSION_EXTEND_INTERVAL:
+        return
+    
+    # Сессия в кеше — тот же объект: следующие запросы в контейнере её уже не продлевают
+    session['expires_at'] = extended
+    if not _pending_extensions:
+        _pending_since = time.monotonic()
+    _pending_extensions.add(token_digest(token))
+
+def flush_session_extensions(conn) -> None:
+    '''Записывает накопленные продления, когда их много или они копятся дольше SESSION_FLUSH_INTERVAL'''
+    if not _pending_extensions:
+        return
+    if len(_pending_extensions) < SESSION_FLUSH_BATCH and time.monotonic() - _pending_since < SESSION_FLUSH_INTERVAL:
+        return
+    
+    token_hashes = list(_pending_extensions)
+    _pending_extensions.clear()
+    with conn.cursor() as cur:
+        cur.execute(
+            """UPDATE user_sessions SET expires_at = NOW() + %s
+               WHERE token_hash = ANY(%s) AND expires_at > NOW()""",
+            (SESSION_TTL, token_hashes)
+        )
+        SESSION_STATS['extended'] += cur.rowcount
+    conn.commit()
+
+# Заявки: проверка незакрытой заявки в apply, свои заявки в my, очередь в list
+PENDING_APPLICATION_SQL = "SELECT id FROM role_applications WHERE user_id = %s AND app_status = 'pending'"
+
+MY_APPLICATIONS_JSON_SQL = """
+    SELECT COALESCE(json_agg(json_build_object(
+               'id', id,
+               'requested_role', requested_role,
+               'status', app_status,
+               'motivation', motivation,
+               'portfolio_url', portfolio_url,
+               'created_at', created_at,
+               'reviewed_at', reviewed_at,
+               'reviewer_comment', reviewer_comment
+           ) ORDER BY created_at DESC), '[]')::text
+    FROM role_applications
+    WHERE user_id = %s
+"""
+
+MY_APPLICATIONS_SQL = """
+    SELECT id, requested_role, app_status, motivation, portfolio_url,
+           created_at, reviewed_at, reviewer_comment
+    FROM role_applications
+    WHERE user_id = %s
+    ORDER BY created_at DESC
+"""
+
+PENDING_APPLICATIONS_JSON_SQL = """
+    SELECT COALESCE(json_agg(json_build_object(
+               'id', ra.id,
+               'user_id', ra.user_id,
+               'username', u.username,
+               'email', u.email,
+               'requested_role', ra.requested_role,
+               'status', ra.app_status,
+               'created_at', ra.created_at
+           ) ORDER BY ra.created_at ASC), '[]')::text
+    FROM role_applications ra
+    JOIN users u ON ra.user_id = u.id
+    WHERE ra.app_status = 'pending'
+"""
+
+PENDING_APPLICATIONS_SQL = """
+    SELECT ra.id, ra.user_id, u.username, u.email, ra.requested_role,
+           ra.app_status, ra.created_at
+    FROM role_applications ra
+    JOIN users u ON ra.user_id = u.id
+    WHERE ra.app_status = 'pending'
+    ORDER BY ra.created_at ASC
+"""
+
+def metrics_allowed(event: dict) -> bool:
+    '''Счётчики отдаются только с заголовком X-Metrics-Token, равным секрету METRICS_TOKEN'''
+    expected = os.environ.get('METRICS_TOKEN', '')
+    provided = next((value or '' for key, value in (event.get('headers') or {}).items()
+                     if key.lower() == 'x-metrics-token'), '')
+    return bool(expected) and hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
 
 def handler(event: dict, context) -> dict:
     '''API для управления ролями пользователей и заявками на новые роли'''
@@ -28,6 +351,21 @@ def handler(event: dict, context) -> dict:
     action = event.get('queryStringParameters', {}).get('action', 'list')
     token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
     
+    if action == 'metrics':
+        if not metrics_allowed(event):
+            return {
+                'statusCode': 403,
+                'headers': headers,
+                'body': json.dumps({'error': 'Доступ запрещён'}),
+                'isBase64Encoded': False
+            }
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({'db': DB_STATS, 'sessions': SESSION_STATS}),
+            'isBase64Encoded': False
+        }
+    
     if not token and action != 'list':
         return {
             'statusCode': 401,
@@ -36,8 +374,7 @@ def handler(event: dict, context) -> dict:
             'isBase64Encoded': False
         }
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -63,8 +400,7 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            cur.execute("SELECT user_id FROM user_sessions WHERE token = %s", (token,))
-            session = cur.fetchone()
+            session = resolve_session(cur, token)
             
             if not session:
                 return {
@@ -74,12 +410,9 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            user_id = session[0]
+            user_id = session['user_id']
             
-            cur.execute(
-                "SELECT id FROM role_applications WHERE user_id = %s AND app_status = 'pending'",
-                (user_id,)
-            )
+            cur.execute(PENDING_APPLICATION_SQL, (user_id,))
             existing = cur.fetchone()
             
             if existing:
@@ -112,8 +445,7 @@ def handler(event: dict, context) -> dict:
             }
         
         elif action == 'my':
-            cur.execute("SELECT user_id FROM user_sessions WHERE token = %s", (token,))
-            session = cur.fetchone()
+            session = resolve_session(cur, token)
             
             if not session:
                 return {
@@ -123,63 +455,59 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            user_id = session[0]
-            
-            cur.execute(
-                """SELECT id, requested_role, app_status, motivation, portfolio_url, 
-                          created_at, reviewed_at, reviewer_comment
-                   FROM role_applications 
-                   WHERE user_id = %s 
-                   ORDER BY created_at DESC""",
-                (user_id,)
-            )
+            user_id = session['user_id']
             
-            applications = []
-            for row in cur.fetchall():
-                applications.append({
-                    'id': row[0],
-                    'requested_role': row[1],
-                    'status': row[2],
-                    'motivation': row[3],
-                    'portfolio_url': row[4],
-                    'created_at': row[5].isoformat() if row[5] else None,
-                    'reviewed_at': row[6].isoformat() if row[6] else None,
-                    'reviewer_comment': row[7]
-                })
+            if SQL_JSON:
+                cur.execute(MY_APPLICATIONS_JSON_SQL, (user_id,))
+                body = f'{{"applications": {cur.fetchone()[0]}}}'
+            else:
+                cur.execute(MY_APPLICATIONS_SQL, (user_id,))
+                
+                applications = []
+                for row in cur.fetchall():
+                    applications.append({
+                        'id': row[0],
+                        'requested_role': row[1],
+                        'status': row[2],
+                        'motivation': row[3],
+                        'portfolio_url': row[4],
+                        'created_at': row[5].isoformat() if row[5] else None,
+                        'reviewed_at': row[6].isoformat() if row[6] else None,
+                        'reviewer_comment': row[7]
+                    })
+                body = json.dumps({'applications': applications})
             
             return {
                 'statusCode': 200,
                 'headers': headers,
-                'body': json.dumps({'applications': applications}),
+                'body': body,
                 'isBase64Encoded': False
             }
         
         elif action == 'list':
-            cur.execute(
-                """SELECT ra.id, ra.user_id, u.username, u.email, ra.requested_role, 
-                          ra.app_status, ra.created_at
-                   FROM role_applications ra
-                   JOIN users u ON ra.user_id = u.id
-                   WHERE ra.app_status = 'pending'
-                   ORDER BY ra.created_at ASC"""
-            )
-            
-            applications = []
-            for row in cur.fetchall():
-                applications.append({
-                    'id': row[0],
-                    'user_id': row[1],
-                    'username': row[2],
-                    'email': row[3],
-                    'requested_role': row[4],
-                    'status': row[5],
-                    'created_at': row[6].isoformat() if row[6] else None
-                })
+            if SQL_JSON:
+                cur.execute(PENDING_APPLICATIONS_JSON_SQL)
+                body = f'{{"applications": {cur.fetchone()[0]}}}'
+            else:
+                cur.execute(PENDING_APPLICATIONS_SQL)
+                
+                applications = []
+                for row in cur.fetchall():
+                    applications.append({
+                        'id': row[0],
+                        'user_id': row[1],
+                        'username': row[2],
+                        'email': row[3],
+                        'requested_role': row[4],
+                        'status': row[5],
+                        'created_at': row[6].isoformat() if row[6] else None
+                    })
+                body = json.dumps({'applications': applications})
             
             return {
                 'statusCode': 200,
                 'headers': headers,
-                'body': json.dumps({'applications': applications}),
+                'body': body,
                 'isBase64Encoded': False
             }
         
@@ -193,4 +521,4 @@ def handler(event: dict, context) -> dict:
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Нагрузочный тест бронирования: много одновременных участников на одно событие.
+
+Запуск (нужна тестовая БД со схемой из db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/booking_concurrency.py --bookers 500 --seats 50 --workers 32
+
+Каждый воркер — отдельный процесс со своим тёплым соединением, как контейнер функции
+events. Скрипт создаёт пользователей и событие, одновременно отправляет action=book,
+печатает пропускную способность и проверяет, что мест занято ровно столько, сколько
+создано бронирований, и не больше max_participants.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from multiprocessing import Pool
+from pathlib import Path
+
+import jwt
+import psycopg2
+
+EVENTS_INDEX = Path(__file__).resolve().parent.parent / 'backend' / 'events' / 'index.py'
+
+_events = None
+
+
+def load_events_module():
+    spec = importlib.util.spec_from_file_location('events_index', EVENTS_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def init_worker():
+    global _events
+    _events = load_events_module()
+    _events.release_db_connection(_events.get_db_connection())
+
+
+def book(args):
+    event_id, token = args
+    started = time.perf_counter()
+    response = _events.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {'action': 'book'},
+        'headers': {'X-Authorization': f'Bearer {token}'},
+        'body': json.dumps({'event_id': event_id})
+    }, None)
+    return response['statusCode'], time.perf_counter() - started
+
+
+def seed(cur, prefix: str, bookers: int, seats: int) -> tuple:
+    cur.execute(
+        "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, '') RETURNING id",
+        (f'{prefix}_org', f'{prefix}_org@bench.local')
+    )
+    organizer_id = cur.fetchone()[0]
+    cur.execute(
+        """INSERT INTO users (username, email, password_hash)
+           SELECT %s || '_' || i, %s || '_' || i || '@bench.local', ''
+           FROM generate_series(1, %s) AS i
+           RETURNING id""",
+        (prefix, prefix, bookers)
+    )
+    user_ids = [row[0] for row in cur.fetchall()]
+    cur.execute(
+        """INSERT INTO events (title, organizer_id, event_date, max_participants,
+                               current_participants, price_per_person, event_status)
+           VALUES (%s, %s, %s, %s, 0, 1000, 'published')
+           RETURNING id""",
+        (f'{prefix} event', organizer_id, datetime.now() + timedelta(days=1), seats)
+    )
+    return cur.fetchone()[0], organizer_id, user_ids
+
+
+def cleanup(cur, event_id: int, organizer_id: int, user_ids: list) -> None:
+    cur.execute("DELETE FROM bookings WHERE event_id = %s", (event_id,))
+    cur.execute("DELETE FROM events WHERE id = %s", (event_id,))
+    cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids + [organizer_id],))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bookers', type=int, default=500)
+    parser.add_argument('--seats', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=32)
+    args = parser.parse_args()
+
+    secret = secrets.token_hex(32)
+    os.environ['JWT_SECRET'] = secret
+    prefix = f'bench_{secrets.token_hex(4)}'
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    event_id, organizer_id, user_ids = seed(cur, prefix, args.bookers, args.seats)
+
+    try:
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        jobs = [
+            (event_id, jwt.encode({'user_id': user_id, 'exp': expires}, secret, algorithm='HS256'))
+            for user_id in user_ids
+        ]
+
+        with Pool(args.workers, initializer=init_worker) as pool:
+            started = time.perf_counter()
+            results = pool.map(book, jobs, chunksize=1)
+            elapsed = time.perf_counter() - started
+
+        statuses = Counter(status for status, _ in results)
+        latencies = sorted(latency * 1000 for _, latency in results)
+
+        cur.execute("SELECT current_participants, max_participants, event_status FROM events WHERE id = %s", (event_id,))
+        current, capacity, status = cur.fetchone()
+        cur.execute("SELECT COUNT(*) FROM bookings WHERE event_id = %s AND booking_status <> 'cancelled'", (event_id,))
+        booked = cur.fetchone()[0]
+
+        print(f'bookers={args.bookers} seats={args.seats} workers={args.workers}')
+        print(f'wall time        {elapsed:.3f} s')
+        print(f'throughput       {len(results) / elapsed:.0f} req/s')
+        print(f'latency p50/p99  {statistics.median(latencies):.1f} / {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms')
+        print(f'responses        {dict(sorted(statuses.items()))}')
+        print(f'event            current_participants={current} bookings={booked} status={status}')
+
+        consistent = current == booked == statuses[201] and current <= capacity
+        print('consistency      OK' if consistent else 'consistency      FAILED (lost update or overbooking)')
+        return 0 if consistent else 1
+    finally:
+        cleanup(cur, event_id, organizer_id, user_ids)
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+Планы запросов функций с индексами миграции и без них.
+
+Запуск (тестовая БД со схемой из всех миграций db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/explain_queries.py \
+        --migration db_migrations/V0008__add_query_indexes.sql --events 50000 --users 20000
+
+Тексты запросов берутся из самих функций, поэтому план снимается ровно для того SQL,
+который они выполняют. Всё выполняется в одной транзакции, которая в конце
+откатывается: скрипт заполняет таблицы тестовыми данными, во вложенной точке
+сохранения удаляет индексы, созданные миграцией, и восстанавливает удалённые ею
+(их определения ищутся в предыдущих миграциях), снимает EXPLAIN (ANALYZE, BUFFERS)
+для каждого запроса, откатывается к точке сохранения, снимает планы ещё раз и
+печатает сравнение. Так сравнение работает при текущей схеме, сколько бы миграций
+ни было применено после проверяемой. С --verbose печатаются полные планы.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import sys
+from datetime import timedelta
+from pathlib import Path
+
+import psycopg2
+
+ANALYZE_SQL = """
+ANALYZE users, user_profiles, user_sessions, events, role_applications, bookings,
+        telegram_auth_tokens, refresh_tokens;
+"""
+
+SEED_SQL = """
+INSERT INTO users (username, email, password_hash, telegram_id)
+SELECT 'explain_' || i, 'explain_' || i || '@bench.local', '', 'tg' || i
+FROM generate_series(1, %(users)s) AS i;
+
+INSERT INTO user_profiles (user_id, user_role)
+SELECT id, CASE WHEN id %% 10 = 0 THEN 'organizer' ELSE 'participant' END
+FROM users WHERE username LIKE 'explain\\_%%';
+
+INSERT INTO user_sessions (user_id, token_hash, expires_at)
+SELECT id, sha256(('explain-token-' || id)::bytea), NOW() + (id %% 60 - 30) * INTERVAL '1 day'
+FROM users WHERE username LIKE 'explain\\_%%';
+
+INSERT INTO events (title, description, organizer_id, event_date, max_participants,
+                    current_participants, price_per_person, event_status)
+SELECT 'Explain event ' || i, 'Парение вениками ' || i, u.id,
+       NOW() + (i - %(events)s / 2) * INTERVAL '1 hour', 10, 0, 1500,
+       (ARRAY['draft', 'published', 'full', 'completed', 'cancelled'])[1 + i %% 5]
+FROM generate_series(1, %(events)s) AS i
+JOIN users u ON u.username = 'explain_' || (1 + i %% %(users)s);
+
+INSERT INTO role_applications (user_id, requested_role, motivation, app_status, created_at)
+SELECT id, 'organizer', repeat('m', 60),
+       (ARRAY['pending', 'approved', 'rejected'])[1 + id %% 3], NOW() - id * INTERVAL '1 minute'
+FROM users WHERE username LIKE 'explain\\_%%';
+
+INSERT INTO bookings (event_id, user_id, total_price)
+SELECT e.id, u.id, 1500
+FROM (SELECT id, row_number() OVER () AS n FROM events WHERE title LIKE 'Explain event %%') e
+JOIN users u ON u.username = 'explain_' || (1 + e.n %% %(users)s);
+
+INSERT INTO telegram_auth_tokens (token_hash, telegram_id, expires_at, used, created_at)
+SELECT md5('explain' || i) || md5('tg' || i), 'tg' || i,
+       NOW() + (i %% 20 - 10) * INTERVAL '1 minute', i %% 2 = 0, NOW() - (i %% 120) * INTERVAL '1 minute'
+FROM generate_series(1, %(users)s) AS i;
+
+INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
+SELECT id, md5('refresh' || id) || md5('r' || id), NOW() + (id %% 60 - 30) * INTERVAL '1 day'
+FROM users WHERE username LIKE 'explain\\_%%';
+
+""" + ANALYZE_SQL
+
+CONTEXT_SQL = """
+SELECT
+    (SELECT id FROM users WHERE username = 'explain_10'),
+    (SELECT email FROM users WHERE username = 'explain_10'),
+    (SELECT id FROM events WHERE title = 'Explain event 1001'),
+    (SELECT event_date FROM events WHERE title = 'Explain event 1001'),
+    (SELECT array_agg(id) FROM events WHERE title LIKE 'Explain event 2__'),
+    (SELECT token_hash FROM telegram_auth_tokens WHERE telegram_id = 'tg11'),
+    (SELECT rt.token_hash FROM refresh_tokens rt JOIN users u ON u.id = rt.user_id
+     WHERE u.username = 'explain_10')
+"""
+
+# Индексы, созданные и удалённые миграцией, и определения удалённых из прежних миграций
+CREATE_INDEX_RE = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+[^;]+;', re.IGNORECASE
+)
+DROP_INDEX_RE = re.compile(r'DROP\s+INDEX\s+(?:IF\s+EXISTS\s+)?(?:\w+\.)?(\w+)', re.IGNORECASE)
+
+FUNCTIONS = Path(__file__).resolve().parent.parent / 'backend'
+
+
+def load_function(name: str, path: Path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def telegram_sql(statements: dict, name: str) -> str:
+    """Выражение telegram-auth в виде для execute: $n -> %(pn)s, схема из search_path"""
+    return re.sub(r'\$(\d+)', r'%(p\1)s', statements[name][1].format(schema=''))
+
+
+def build_queries() -> list:
+    """(имя, запрос, параметры из контекста, изменяет ли данные) — тексты берутся из функций"""
+    auth = load_function('auth_index', FUNCTIONS / 'auth' / 'index.py')
+    events = load_function('events_index', FUNCTIONS / 'events' / 'index.py')
+    roles = load_function('roles_index', FUNCTIONS / 'roles' / 'index.py')
+    telegram = load_function(
+        'telegram_auth_index', FUNCTIONS / 'extensions' / 'telegram-bot' / 'telegram-auth' / 'index.py'
+    ).STATEMENTS
+    fields = events.parse_fields(None)
+    page = lambda conditions: events.list_page_query(fields, conditions, [], 50)[0]
+    page_params = lambda *args: events.list_page_query(fields, [], list(args), 50)[1]
+    digest = lambda c: events.token_digest(f"explain-token-{c['user_id']}")
+    login = lambda c: auth.login_query(c['email'], auth.login_buckets(c['email'], '198.51.100.7'))
+
+    return [
+        ('events.list stamp published', events.LIST_STAMP_SQL, lambda c: ('published',), False),
+        ('events.list stamp all', events.LIST_STAMP_ALL_SQL, lambda c: (), False),
+        ('events.list published', page(['event_status = %s']), lambda c: page_params('published'), False),
+        ('events.list published after cursor', page(['event_status = %s', '(event_date, id) > (%s, %s)']),
+            lambda c: page_params('published', c['event_date'], c['event_id']), False),
+        ('events.list all', page([]), lambda c: page_params(), False),
+        ('events.get stamp', events.EVENT_STAMP_SQL, lambda c: (c['event_id'],), False),
+        ('events.get ids stamp', events.BATCH_STAMP_SQL, lambda c: (c['event_ids'],), False),
+        ('events.book', events.BOOK_SQL, lambda c: (c['event_id'], c['user_id']), True),
+        ('events.cancel', events.CANCEL_SQL, lambda c: (c['event_id'], c['user_id']), True),
+        ('events.session', events.SESSION_SQL, lambda c: (digest(c),), False),
+        ('roles.session', roles.SESSION_SQL, lambda c: (digest(c),), False),
+        ('roles.apply pending check', roles.PENDING_APPLICATION_SQL, lambda c: (c['user_id'],), False),
+        ('roles.my', roles.MY_APPLICATIONS_JSON_SQL, lambda c: (c['user_id'],), False),
+        ('roles.list', roles.PENDING_APPLICATIONS_JSON_SQL, lambda c: (), False),
+        ('auth.register', auth.REGISTER_SQL,
+            lambda c: {'username': 'explain_new', 'email': c['email'], 'password_hash': '',
+                       'role': 'participant', 'phone': ''}, True),
+        ('auth.login', login({'email': ''})[0], lambda c: login(c)[1], True),
+        ('auth.logout', auth.LOGOUT_SQL, lambda c: (digest(c),), True),
+        ('auth.reap sessions', auth.REAP_SESSIONS_SQL, lambda c: (500,), True),
+        ('auth.reap throttle', auth.REAP_THROTTLE_SQL, lambda c: (auth.THROTTLE_IDLE, 500), True),
+        ('telegram-auth.token state', telegram_sql(telegram, 'get_auth_token_state'),
+            lambda c: {'p1': '0' * 64}, False),
+        ('telegram-auth.exchange', telegram_sql(telegram, 'exchange_auth_token'),
+            lambda c: {'p1': c['auth_hash'], 'p2': '1' * 64, 'p3': c['event_date']}, True),
+        ('telegram-auth.rotate refresh', telegram_sql(telegram, 'rotate_refresh_token'),
+            lambda c: {'p1': c['refresh_hash'], 'p2': '1' * 64, 'p3': timedelta(seconds=10)}, True),
+        ('telegram-auth.logout', telegram_sql(telegram, 'delete_refresh_family'),
+            lambda c: {'p1': c['refresh_hash']}, True),
+    ] + [
+        (f'telegram-auth.{name}', telegram_sql(telegram, name), lambda c: {'p1': 500}, True)
+        for name in telegram if name.startswith('reap_')
+    ]
+
+
+def explain(cur, sql: str, params: tuple, writes: bool) -> dict:
+    if writes:
+        cur.execute('SAVEPOINT explain_write')
+    cur.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}', params)
+    plan = cur.fetchone()[0][0]
+    if writes:
+        cur.execute('ROLLBACK TO SAVEPOINT explain_write')
+    return plan
+
+
+def plan_nodes(node: dict) -> list:
+    label = node['Node Type']
+    if node.get('Index Name'):
+        label += f" ({node['Index Name']})"
+    elif node.get('Relation Name'):
+        label += f" ({node['Relation Name']})"
+    nodes = [label]
+    for child in node.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def collect(cur, queries: list, context: dict) -> dict:
+    plans = {}
+    for name, sql, params, writes in queries:
+        plans[name] = explain(cur, sql, params(context), writes)
+    return plans
+
+
+def migration_indexes(migration: Path) -> tuple:
+    """Созданные миграцией индексы и CREATE INDEX для удалённых ею — из предыдущих миграций"""
+    text = migration.read_text(encoding='utf-8')
+    created = [match.group(1) for match in CREATE_INDEX_RE.finditer(text)]
+    dropped = {name: None for name in DROP_INDEX_RE.findall(text)}
+    for earlier in sorted(migration.parent.glob('V*.sql')):
+        if earlier.name >= migration.name:
+            break
+        for match in CREATE_INDEX_RE.finditer(earlier.read_text(encoding='utf-8')):
+            if match.group(1) in dropped:
+                dropped[match.group(1)] = match.group(0)
+    missing = [name for name, definition in dropped.items() if definition is None]
+    if missing:
+        raise SystemExit(f'no CREATE INDEX for {", ".join(missing)} before {migration.name}')
+    return created, list(dropped.values())
+
+
+def summary(plan: dict) -> str:
+    top = plan['Plan']
+    buffers = top.get('Shared Hit Blocks', 0) + top.get('Shared Read Blocks', 0)
+    return f"{plan['Execution Time']:>9.2f} ms {buffers:>7} buf"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--migration', type=Path, default=Path('db_migrations/V0008__add_query_indexes.sql'))
+    parser.add_argument('--schema', default='t_p33228717_sparcom_landing_page')
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    queries = build_queries()
+    created, restored = migration_indexes(args.migration)
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    try:
+        cur.execute(f'SET LOCAL search_path TO {args.schema}')
+        cur.execute(SEED_SQL, {'events': args.events, 'users': args.users})
+        cur.execute(CONTEXT_SQL)
+        user_id, email, event_id, event_date, event_ids, auth_hash, refresh_hash = cur.fetchone()
+        context = {
+            'user_id': user_id, 'email': email,
+            'event_id': event_id, 'event_date': event_date, 'event_ids': event_ids,
+            'auth_hash': auth_hash, 'refresh_hash': refresh_hash
+        }
+
+        # Схема до миграции: без её индексов, с удалёнными ею
+        cur.execute('SAVEPOINT before_migration')
+        for name in created:
+            cur.execute(f'DROP INDEX IF EXISTS {name}')
+        for definition in restored:
+            cur.execute(definition)
+        cur.execute(ANALYZE_SQL)
+        before = collect(cur, queries, context)
+        cur.execute('ROLLBACK TO SAVEPOINT before_migration')
+
+        cur.execute(ANALYZE_SQL)
+        after = collect(cur, queries, context)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    print(f'{"query":<36} {"before":>22} {"after":>22}')
+    for name, *_ in queries:
+        print(f'{name:<36} {summary(before[name]):>22} {summary(after[name]):>22}')
+        before_nodes, after_nodes = plan_nodes(before[name]['Plan']), plan_nodes(after[name]['Plan'])
+        if before_nodes != after_nodes:
+            print(f'    before: {" -> ".join(before_nodes)}')
+            print(f'    after:  {" -> ".join(after_nodes)}')
+
+    if args.verbose:
+        for name, *_ in queries:
+            print(f'\n=== {name}\n--- before\n{json.dumps(before[name], indent=2)}'
+                  f'\n--- after\n{json.dumps(after[name], indent=2)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Сравнение сборки ответа events?action=list в Python и в PostgreSQL (SQL_JSON).
+
+Запуск (нужна тестовая БД со схемой из db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/json_rendering.py --rows 10000 --repeat 20
+
+Скрипт создаёт страницу из --rows событий, вызывает handler с SQL_JSON выключенным
+и включённым и печатает для каждого пути процессорное время функции (без времени
+сервера БД), полное время ответа и пиковое выделение памяти в Python.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import psycopg2
+
+EVENTS_INDEX = Path(__file__).resolve().parent.parent / 'backend' / 'events' / 'index.py'
+
+
+def load_events_module():
+    spec = importlib.util.spec_from_file_location('events_index', EVENTS_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed(cur, prefix: str, rows: int) -> int:
+    cur.execute(
+        "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, '') RETURNING id",
+        (prefix, f'{prefix}@bench.local')
+    )
+    organizer_id = cur.fetchone()[0]
+    cur.execute(
+        """INSERT INTO events (title, description, organizer_id, event_date, max_participants,
+                               current_participants, price_per_person, event_status, created_at)
+           SELECT %s || ' #' || i, repeat('Парение вениками, чай и травы. ', 8), %s,
+                  %s + i * INTERVAL '1 hour', 12, i %% 12, 1500 + i %% 500, 'draft', NOW()
+           FROM generate_series(1, %s) AS i""",
+        (prefix, organizer_id, datetime(2100, 1, 1), rows)
+    )
+    return organizer_id
+
+
+def measure(events, request: dict, repeat: int) -> dict:
+    cpu, wall, peak, size = [], [], 0, 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        response = events.handler(request, None)
+        cpu.append(time.process_time() - cpu_started)
+        wall.append(time.perf_counter() - wall_started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        size = len(response['body'])
+    return {
+        'cpu_ms': statistics.median(cpu) * 1000,
+        'wall_ms': statistics.median(wall) * 1000,
+        'peak_kib': peak / 1024,
+        'body_kib': size / 1024,
+        'body': response['body']
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    prefix = f'bench_{secrets.token_hex(4)}'
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    organizer_id = seed(cur, prefix, args.rows)
+
+    try:
+        events = load_events_module()
+        events.MAX_PAGE_SIZE = args.rows
+        request = {
+            'httpMethod': 'GET',
+            'queryStringParameters': {'action': 'list', 'status': 'draft', 'limit': str(args.rows)},
+            'headers': {}
+        }
+
+        results = {}
+        for name, enabled in (('python', False), ('sql_json', True)):
+            events.SQL_JSON = enabled
+            events.handler(request, None)
+            results[name] = measure(events, request, args.repeat)
+
+        print(f'rows={args.rows} repeat={args.repeat}')
+        print(f'{"path":<10} {"cpu ms":>10} {"wall ms":>10} {"peak KiB":>10} {"body KiB":>10}')
+        for name, result in results.items():
+            print(f'{name:<10} {result["cpu_ms"]:>10.1f} {result["wall_ms"]:>10.1f} '
+                  f'{result["peak_kib"]:>10.0f} {result["body_kib"]:>10.0f}')
+
+        python_events = json.loads(results['python']['body'])['events']
+        sql_events = json.loads(results['sql_json']['body'])['events']
+        same = [e['id'] for e in python_events] == [e['id'] for e in sql_events]
+        print('same rows        OK' if same else 'same rows        FAILED')
+        return 0 if same else 1
+    finally:
+        cur.execute("DELETE FROM events WHERE organizer_id = %s", (organizer_id,))
+        cur.execute("DELETE FROM users WHERE id = %s", (organizer_id,))
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
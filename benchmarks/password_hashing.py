@@ -0,0 +1,75 @@
+"""
+Стоимость проверки пароля при входе для разных схем и параметров хеширования.
+
+Запуск (БД не нужна):
+
+    python benchmarks/password_hashing.py --seconds 3
+
+Для каждой настройки скрипт в одном процессе проверяет пароль через verify_password
+из функции auth и печатает время одной проверки и число входов в секунду на ядро.
+Добавить свою настройку: --setting pbkdf2-sha256:i=120000 --setting scrypt:n=32768,r=8,p=1
+"""
+
+import argparse
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+AUTH_INDEX = Path(__file__).resolve().parent.parent / 'backend' / 'auth' / 'index.py'
+
+DEFAULT_SETTINGS = [
+    'legacy',
+    'pbkdf2-sha256:i=50000',
+    'pbkdf2-sha256:i=100000',
+    'pbkdf2-sha256:i=310000',
+    'scrypt:n=8192,r=8,p=1',
+    'scrypt:n=16384,r=8,p=1',
+    'scrypt:n=32768,r=8,p=1',
+]
+
+
+def load_auth_module():
+    spec = importlib.util.spec_from_file_location('auth_index', AUTH_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_hash(auth, setting: str, password: str) -> str:
+    if setting == 'legacy':
+        salt = b'0123456789abcdef0123456789abcdef'
+        key = auth.hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, auth.LEGACY_PBKDF2_ITERATIONS)
+        return (salt + key).hex()
+    scheme, encoded_params = setting.split(':')
+    params = {name: int(value) for name, value in (item.split('=') for item in encoded_params.split(','))}
+    return auth.hash_password(password, scheme, params)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--setting', action='append')
+    args = parser.parse_args()
+
+    auth = load_auth_module()
+    password = 'correct horse battery staple'
+
+    print(f'{"setting":<28} {"ms/verify":>10} {"logins/s/core":>14}')
+    for setting in args.setting or DEFAULT_SETTINGS:
+        stored = make_hash(auth, setting, password)
+        assert auth.verify_password(stored, password)
+
+        count = 0
+        started = time.process_time()
+        while time.process_time() - started < args.seconds:
+            auth.verify_password(stored, password)
+            count += 1
+        elapsed = time.process_time() - started
+
+        print(f'{setting:<28} {elapsed / count * 1000:>10.2f} {count / elapsed:>14.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Стоимость разбора и планирования запросов функции telegram-auth: текст SQL на каждый
+вызов против PREPARE один раз на соединение и EXECUTE.
+
+Запуск (нужна тестовая БД со схемой из db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/prepared_statements.py --calls 5000
+
+psycopg2 подставляет параметры на клиенте, поэтому и прежние f-строки, и execute
+с %s присылают серверу новый текст на каждый вызов — Postgres каждый раз разбирает
+и планирует его заново. Скрипт создаёт тестовых пользователей с токенами входа и
+refresh-токенами, выполняет проверку токена входа и ротацию refresh-токена из
+STATEMENTS обоими способами (prepared — через run_query функции), печатает p50/p99
+на вызов, затем время планирования атомарного обмена токена по EXPLAIN (SUMMARY)
+и удаляет тестовые данные.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import re
+import secrets
+import statistics
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import psycopg2
+
+TELEGRAM_AUTH_INDEX = (Path(__file__).resolve().parent.parent / 'backend' / 'extensions'
+                       / 'telegram-bot' / 'telegram-auth' / 'index.py')
+
+MEASURED = ('get_auth_token_state', 'rotate_refresh_token')
+
+
+def load_telegram_auth_module():
+    spec = importlib.util.spec_from_file_location('telegram_auth_index', TELEGRAM_AUTH_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def client_sql(sql: str, schema: str) -> str:
+    """$n -> %(pn)s: тот же запрос в виде, в котором его прислал бы execute"""
+    return re.sub(r'\$(\d+)', r'%(p\1)s', sql.format(schema=schema))
+
+
+def seed(cur, prefix: str, users: int) -> list:
+    """Пользователи с токеном входа и refresh-токеном: [{'user_id', 'auth_hash', 'refresh_hash'}]"""
+    rows = []
+    for i in range(users):
+        telegram_id = f'{prefix}{i}'
+        cur.execute(
+            """INSERT INTO users (username, email, telegram_id, password_hash)
+               VALUES (%s, %s, %s, '') RETURNING id""",
+            (telegram_id, f'{telegram_id}@bench.local', telegram_id)
+        )
+        row = {'user_id': cur.fetchone()[0],
+               'auth_hash': hash_token(secrets.token_urlsafe(32)),
+               'refresh_hash': hash_token(secrets.token_urlsafe(48))}
+        cur.execute(
+            """INSERT INTO telegram_auth_tokens (token_hash, telegram_id, telegram_first_name, expires_at)
+               VALUES (%s, %s, %s, NOW() + INTERVAL '10 minutes')""",
+            (row['auth_hash'], telegram_id, "O'Brien")
+        )
+        cur.execute(
+            "INSERT INTO refresh_tokens (user_id, token_hash, expires_at) VALUES (%s, %s, NOW() + INTERVAL '30 days')",
+            (row['user_id'], row['refresh_hash'])
+        )
+        rows.append(row)
+    return rows
+
+
+def statement_params(name: str, row: dict) -> tuple:
+    """Параметры очередного вызова; ротация продолжает цепочку refresh-токенов пользователя"""
+    if name == 'get_auth_token_state':
+        return (row['auth_hash'],)
+    new_hash = hash_token(secrets.token_urlsafe(48))
+    old_hash, row['refresh_hash'] = row['refresh_hash'], new_hash
+    return old_hash, new_hash, timedelta(seconds=10)
+
+
+def percentiles(latencies: list) -> str:
+    latencies = sorted(latency * 1e6 for latency in latencies)
+    return f'{statistics.median(latencies):>8.0f} {latencies[int(len(latencies) * 0.99) - 1]:>8.0f}'
+
+
+def planning_ms(cur, sql: str, params) -> float:
+    cur.execute(f'EXPLAIN (SUMMARY, FORMAT JSON) {sql}', params)
+    return cur.fetchone()[0][0]['Planning Time']
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--schema', default='t_p33228717_sparcom_landing_page')
+    args = parser.parse_args()
+
+    os.environ['MAIN_DB_SCHEMA'] = args.schema
+    os.environ.setdefault('JWT_SECRET', secrets.token_hex(32))
+    schema = f'{args.schema}.'
+    prefix = f'bench{secrets.token_hex(3)}_'
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'], options=f'-c search_path={args.schema}')
+    conn.autocommit = True
+    cur = conn.cursor()
+    rows = seed(cur, prefix, args.users)
+    telegram_auth = load_telegram_auth_module()
+
+    try:
+        print(f'calls={args.calls} users={args.users}')
+        print(f'{"statement":<22} {"mode":<9} {"p50 us":>8} {"p99 us":>8}')
+        for name in MEASURED:
+            sql = client_sql(telegram_auth.STATEMENTS[name][1], schema)
+            for mode in ('text', 'prepared'):
+                latencies = []
+                for i in range(args.calls):
+                    params = statement_params(name, rows[i % len(rows)])
+                    started = time.perf_counter()
+                    if mode == 'text':
+                        cur.execute(sql, {f'p{n}': value for n, value in enumerate(params, 1)})
+                    else:
+                        telegram_auth.run_query(cur, name, *params)
+                    cur.fetchone()
+                    latencies.append(time.perf_counter() - started)
+                print(f'{name:<22} {mode:<9} {percentiles(latencies)}')
+
+        # Планирование обмена токена: самый тяжёлый запрос функции. Первые пять
+        # EXECUTE Postgres планирует заново, дальше берёт общий план из кеша
+        params = (rows[0]['auth_hash'], hash_token(secrets.token_urlsafe(48)), '2000-01-01')
+        text_ms = planning_ms(
+            cur, client_sql(telegram_auth.STATEMENTS['exchange_auth_token'][1], schema),
+            {'p1': params[0], 'p2': params[1], 'p3': params[2]}
+        )
+        types, sql = telegram_auth.STATEMENTS['exchange_auth_token']
+        cur.execute(f'PREPARE bench_exchange ({types}) AS {sql.format(schema=schema)}')
+        for _ in range(6):
+            prepared_ms = planning_ms(cur, 'EXECUTE bench_exchange (%s, %s, %s)', params)
+        cur.execute('DEALLOCATE bench_exchange')
+        print(f'exchange_auth_token planning: text {text_ms:.3f} ms, prepared {prepared_ms:.3f} ms')
+        print(f'run_query: {telegram_auth.QUERY_STATS}')
+        return 0
+    finally:
+        cur.execute("DELETE FROM refresh_tokens WHERE user_id = ANY(%s)", ([row['user_id'] for row in rows],))
+        cur.execute("DELETE FROM users WHERE telegram_id LIKE %s", (f'{prefix}%',))
+        cur.execute("DELETE FROM telegram_auth_tokens WHERE telegram_id LIKE %s", (f'{prefix}%',))
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
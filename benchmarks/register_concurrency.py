@@ -0,0 +1,112 @@
+"""
+Параллельные регистрации с одинаковыми email/username.
+
+Запуск (нужна тестовая БД со схемой из db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/register_concurrency.py --attempts 64 --workers 32
+
+Для каждого сценария (одинаковый email, одинаковый username, оба одинаковые) воркеры —
+отдельные процессы со своими соединениями — одновременно вызывают auth?action=register.
+Успешной должна быть ровно одна регистрация, остальные получают 409, и в БД остаётся
+один пользователь с одним профилем.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import sys
+from collections import Counter
+from multiprocessing import Pool
+from pathlib import Path
+
+import psycopg2
+
+AUTH_INDEX = Path(__file__).resolve().parent.parent / 'backend' / 'auth' / 'index.py'
+
+_auth = None
+
+
+def init_worker():
+    global _auth
+    spec = importlib.util.spec_from_file_location('auth_index', AUTH_INDEX)
+    _auth = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(_auth)
+    _auth.release_db_connection(_auth.get_db_connection())
+
+
+def register(body: dict) -> tuple:
+    response = _auth.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {'action': 'register'},
+        'headers': {},
+        'body': json.dumps(body)
+    }, None)
+    return response['statusCode'], json.loads(response['body']).get('conflict')
+
+
+def scenarios(prefix: str, attempts: int) -> dict:
+    return {
+        'same email': [
+            {'username': f'{prefix}_e{i}', 'email': f'{prefix}_e@bench.local', 'password': 'pw'}
+            for i in range(attempts)
+        ],
+        'same username': [
+            {'username': f'{prefix}_u', 'email': f'{prefix}_u{i}@bench.local', 'password': 'pw'}
+            for i in range(attempts)
+        ],
+        'same both': [
+            {'username': f'{prefix}_b', 'email': f'{prefix}_b@bench.local', 'password': 'pw'}
+            for i in range(attempts)
+        ],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attempts', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=32)
+    args = parser.parse_args()
+
+    # Быстрый хеш: проверяется гонка в БД, а не стоимость PBKDF2
+    os.environ.setdefault('PBKDF2_ITERATIONS', '1000')
+    prefix = f'bench_{secrets.token_hex(4)}'
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    ok = True
+    try:
+        with Pool(args.workers, initializer=init_worker) as pool:
+            for name, bodies in scenarios(prefix, args.attempts).items():
+                results = pool.map(register, bodies, chunksize=1)
+                statuses = Counter(status for status, _ in results)
+                conflicts = Counter(','.join(conflict) for status, conflict in results if status == 409)
+
+                cur.execute(
+                    """SELECT COUNT(DISTINCT u.id), COUNT(p.id) FROM users u
+                       LEFT JOIN user_profiles p ON p.user_id = u.id
+                       WHERE u.username = ANY(%s) OR u.email = ANY(%s)""",
+                    ([body['username'] for body in bodies], [body['email'] for body in bodies])
+                )
+                users, profiles = cur.fetchone()
+
+                passed = statuses[201] == 1 and statuses[409] == len(bodies) - 1 and users == profiles == 1
+                ok = ok and passed
+                print(f'{name:<14} responses={dict(sorted(statuses.items()))} '
+                      f'conflict={dict(conflicts)} users={users} profiles={profiles} '
+                      f'{"OK" if passed else "FAILED"}')
+    finally:
+        cur.execute(
+            "DELETE FROM user_profiles WHERE user_id IN (SELECT id FROM users WHERE username LIKE %s)",
+            (f'{prefix}\\_%',)
+        )
+        cur.execute("DELETE FROM users WHERE username LIKE %s", (f'{prefix}\\_%',))
+        conn.close()
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Размер и скорость поиска сессий: сырой токен VARCHAR против SHA-256 в bytea.
+
+Запуск (подойдёт любая БД PostgreSQL 11+, схема проекта не нужна):
+
+    DATABASE_URL=postgres://... python benchmarks/session_tokens.py --sessions 200000 --lookups 5000
+
+Скрипт создаёт две временные таблицы: как до миграции V0012 (token VARCHAR(255)
+UNIQUE плюс отдельный индекс по token) и как после (token_hash BYTEA с покрывающим
+индексом INCLUDE (user_id, expires_at)), заполняет их одними и теми же токенами и
+печатает размеры таблиц и индексов, задержку поиска живой сессии и план запроса.
+"""
+
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+SETUP_SQL = """
+CREATE TEMP TABLE sessions_raw (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    token VARCHAR(255) UNIQUE NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+CREATE INDEX ON sessions_raw(token);
+
+INSERT INTO sessions_raw (user_id, token, expires_at)
+SELECT i %% 50000, substr(translate(encode(sha256((i::text || random()::text)::bytea), 'base64'), '+/', '-_'), 1, 43),
+       NOW() + (i %% 60 - 10) * INTERVAL '1 day'
+FROM generate_series(1, %(sessions)s) AS i;
+
+CREATE TEMP TABLE sessions_hashed (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    token_hash BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+CREATE INDEX ON sessions_hashed(token_hash) INCLUDE (user_id, expires_at);
+
+INSERT INTO sessions_hashed (id, user_id, token_hash, created_at, expires_at)
+SELECT id, user_id, sha256(convert_to(token, 'UTF8')), created_at, expires_at FROM sessions_raw;
+"""
+
+SIZE_SQL = """
+SELECT pg_relation_size(%(table)s::regclass), pg_indexes_size(%(table)s::regclass)
+"""
+
+LOOKUPS = {
+    'raw': "SELECT user_id, expires_at FROM sessions_raw WHERE token = %s AND expires_at > NOW()",
+    'hashed': "SELECT user_id, expires_at FROM sessions_hashed WHERE token_hash = %s AND expires_at > NOW()",
+}
+
+
+def lookup_param(name: str, token: str):
+    return hashlib.sha256(token.encode('utf-8')).digest() if name == 'hashed' else token
+
+
+def plan_summary(cur, name: str, token: str) -> str:
+    cur.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {LOOKUPS[name]}', (lookup_param(name, token),))
+    plan = cur.fetchone()[0][0]['Plan']
+    summary = plan['Node Type']
+    if 'Heap Fetches' in plan:
+        summary += f", heap fetches {plan['Heap Fetches']}"
+    return f"{summary}, buffers {plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(SETUP_SQL, {'sessions': args.sessions})
+        cur.execute('VACUUM ANALYZE sessions_raw')
+        cur.execute('VACUUM ANALYZE sessions_hashed')
+        cur.execute(
+            "SELECT token FROM sessions_raw WHERE expires_at > NOW() ORDER BY random() LIMIT %s",
+            (args.lookups,)
+        )
+        tokens = [row[0] for row in cur.fetchall()]
+
+        print(f'sessions={args.sessions} lookups={len(tokens)}')
+        print(f'{"layout":<8} {"heap MiB":>9} {"index MiB":>10} {"p50 us":>8} {"p99 us":>8}  plan')
+        for name, table in (('raw', 'sessions_raw'), ('hashed', 'sessions_hashed')):
+            cur.execute(SIZE_SQL, {'table': table})
+            heap, indexes = cur.fetchone()
+
+            latencies = []
+            for token in tokens:
+                started = time.perf_counter()
+                cur.execute(LOOKUPS[name], (lookup_param(name, token),))
+                cur.fetchone()
+                latencies.append((time.perf_counter() - started) * 1e6)
+            latencies.sort()
+
+            print(f'{name:<8} {heap / 2 ** 20:>9.1f} {indexes / 2 ** 20:>10.1f} '
+                  f'{statistics.median(latencies):>8.0f} {latencies[int(len(latencies) * 0.99) - 1]:>8.0f}  '
+                  f'{plan_summary(cur, name, tokens[0])}')
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
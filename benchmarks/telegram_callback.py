@@ -0,0 +1,166 @@
+"""
+Задержка обмена токена Telegram-входа (telegram-auth?action=callback): прежняя
+последовательность запросов против одного атомарного выражения.
+
+Запуск (нужна тестовая БД со схемой из db_migrations):
+
+    DATABASE_URL=postgres://... python benchmarks/telegram_callback.py --logins 2000
+
+Скрипт создаёт токены входа (половина — для уже существующих пользователей),
+обменивает их прежним путём (get_auth_token, поиск пользователя, UPDATE или INSERT
+users, mark_token_used, роль, сохранение refresh-токена — каждый шаг отдельным
+запросом) и через handler функции, печатает p50/p99 и число запросов к БД на вход,
+затем удаляет тестовые данные.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import psycopg2
+
+TELEGRAM_AUTH_INDEX = (Path(__file__).resolve().parent.parent / 'backend' / 'extensions'
+                       / 'telegram-bot' / 'telegram-auth' / 'index.py')
+
+
+def load_telegram_auth_module():
+    spec = importlib.util.spec_from_file_location('telegram_auth_index', TELEGRAM_AUTH_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def seed(cur, prefix: str, logins: int) -> dict:
+    """Токены для обоих путей: {'old': [...], 'new': [...]}, у чётных — существующий пользователь"""
+    tokens = {'old': [], 'new': []}
+    for path in tokens:
+        for i in range(logins):
+            telegram_id = f'{prefix}{path}{i}'
+            token = secrets.token_urlsafe(32)
+            tokens[path].append(token)
+            if i % 2 == 0:
+                cur.execute(
+                    "INSERT INTO users (username, email, telegram_id, password_hash) VALUES (%s, %s, %s, '')",
+                    (telegram_id, f'{telegram_id}@bench.local', telegram_id)
+                )
+            cur.execute(
+                """INSERT INTO telegram_auth_tokens (token_hash, telegram_id, telegram_username,
+                                                     telegram_first_name, expires_at)
+                   VALUES (%s, %s, %s, %s, NOW() + INTERVAL '10 minutes')""",
+                (hash_token(token), telegram_id, telegram_id, "O'Brien")
+            )
+    return tokens
+
+
+def old_exchange(cur, token: str) -> int:
+    """Прежний handle_callback: отдельный запрос на каждый шаг, возвращает число запросов"""
+    token_hash = hash_token(token)
+    cur.execute(
+        """SELECT telegram_id, telegram_username, telegram_first_name, telegram_last_name,
+                  telegram_photo_url, expires_at, used
+           FROM telegram_auth_tokens WHERE token_hash = %s""",
+        (token_hash,)
+    )
+    telegram_id, username, first_name, last_name, photo_url, _, used = cur.fetchone()
+    assert not used
+    cur.execute("SELECT id FROM users WHERE telegram_id = %s", (telegram_id,))
+    if cur.fetchone():
+        cur.execute(
+            """UPDATE users SET first_name = COALESCE(%s, first_name),
+                                avatar_url = COALESCE(%s, avatar_url), last_login_at = NOW()
+               WHERE telegram_id = %s RETURNING id""",
+            (first_name, photo_url, telegram_id)
+        )
+    else:
+        cur.execute(
+            """INSERT INTO users (telegram_id, username, first_name, last_name, avatar_url,
+                                  email_verified, password_hash, last_login_at)
+               VALUES (%s, %s, %s, %s, %s, TRUE, '', NOW()) RETURNING id""",
+            (telegram_id, username, first_name, last_name, photo_url)
+        )
+    user_id = cur.fetchone()[0]
+    cur.execute("UPDATE telegram_auth_tokens SET used = TRUE WHERE token_hash = %s AND used = FALSE", (token_hash,))
+    cur.execute(
+        """SELECT p.user_role, u.session_generation FROM users u
+           LEFT JOIN user_profiles p ON p.user_id = u.id WHERE u.id = %s""",
+        (user_id,)
+    )
+    cur.fetchone()
+    cur.execute(
+        "INSERT INTO refresh_tokens (user_id, token_hash, expires_at) VALUES (%s, %s, %s)",
+        (user_id, hash_token(secrets.token_urlsafe(48)), datetime.now(timezone.utc) + timedelta(days=30))
+    )
+    return 6
+
+
+def percentiles(latencies: list) -> str:
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return f'{statistics.median(latencies):>8.2f} {latencies[int(len(latencies) * 0.99) - 1]:>8.2f}'
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=2000)
+    parser.add_argument('--schema', default='t_p33228717_sparcom_landing_page')
+    args = parser.parse_args()
+
+    os.environ['MAIN_DB_SCHEMA'] = args.schema
+    os.environ.setdefault('JWT_SECRET', secrets.token_hex(32))
+    prefix = f'bench{secrets.token_hex(3)}_'
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'], options=f'-c search_path={args.schema}')
+    conn.autocommit = True
+    cur = conn.cursor()
+    tokens = seed(cur, prefix, args.logins)
+
+    try:
+        old_latencies = []
+        for token in tokens['old']:
+            started = time.perf_counter()
+            old_exchange(cur, token)
+            old_latencies.append(time.perf_counter() - started)
+
+        telegram_auth = load_telegram_auth_module()
+        telegram_auth.release_db_connection(telegram_auth.get_db_connection())
+        new_latencies, failures = [], 0
+        for token in tokens['new']:
+            started = time.perf_counter()
+            response = telegram_auth.handler({
+                'httpMethod': 'POST',
+                'queryStringParameters': {'action': 'callback'},
+                'body': json.dumps({'token': token})
+            }, None)
+            new_latencies.append(time.perf_counter() - started)
+            failures += response['statusCode'] != 200
+
+        print(f'logins={args.logins} (half for existing users)')
+        print(f'{"path":<12} {"queries":>8} {"p50 ms":>8} {"p99 ms":>8}')
+        print(f'{"sequential":<12} {6:>8} {percentiles(old_latencies)}')
+        print(f'{"one stmt":<12} {1:>8} {percentiles(new_latencies)}')
+        print('exchange         OK' if not failures else f'exchange         FAILED ({failures} non-200)')
+        return 0 if not failures else 1
+    finally:
+        cur.execute(
+            """DELETE FROM refresh_tokens WHERE user_id IN (
+                   SELECT id FROM users WHERE telegram_id LIKE %s)""",
+            (f'{prefix}%',)
+        )
+        cur.execute("DELETE FROM users WHERE telegram_id LIKE %s", (f'{prefix}%',))
+        cur.execute("DELETE FROM telegram_auth_tokens WHERE telegram_id LIKE %s", (f'{prefix}%',))
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+-- Версии данных событий по статусам: основа ETag для events?action=list.
+-- Счётчик статуса разбит на 8 строк: каждое выражение над events
+-- увеличивает одну случайную из них, поэтому параллельные бронирования не ждут
+-- одну общую блокировку. Версия статуса — сумма его строк; счётчик меняется в той же
+-- транзакции, что и events, и виден читателям только вместе с её фиксацией.
+CREATE TABLE IF NOT EXISTS t_p33228717_sparcom_landing_page.events_version (
+    event_status VARCHAR(50) NOT NULL,
+    slot SMALLINT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (event_status, slot)
+);
+
+-- Один раз на выражение (а не на строку): статусы берутся из таблиц переходов,
+-- строки счётчика блокируются в порядке статусов
+CREATE OR REPLACE FUNCTION t_p33228717_sparcom_landing_page.bump_events_version()
+RETURNS TRIGGER AS $$
+DECLARE
+    bump_slot SMALLINT := floor(random() * 8);
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO t_p33228717_sparcom_landing_page.events_version (event_status, slot, version)
+        SELECT DISTINCT event_status, bump_slot, 1 FROM new_rows ORDER BY event_status
+        ON CONFLICT (event_status, slot) DO UPDATE SET version = events_version.version + 1;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO t_p33228717_sparcom_landing_page.events_version (event_status, slot, version)
+        SELECT event_status, bump_slot, 1
+        FROM (SELECT event_status FROM old_rows UNION SELECT event_status FROM new_rows) AS changed
+        ORDER BY event_status
+        ON CONFLICT (event_status, slot) DO UPDATE SET version = events_version.version + 1;
+    ELSE
+        INSERT INTO t_p33228717_sparcom_landing_page.events_version (event_status, slot, version)
+        SELECT DISTINCT event_status, bump_slot, 1 FROM old_rows ORDER BY event_status
+        ON CONFLICT (event_status, slot) DO UPDATE SET version = events_version.version + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Таблицы переходов допускают только одно событие на триггер
+DROP TRIGGER IF EXISTS trg_events_version_insert ON t_p33228717_sparcom_landing_page.events;
+DROP TRIGGER IF EXISTS trg_events_version_update ON t_p33228717_sparcom_landing_page.events;
+DROP TRIGGER IF EXISTS trg_events_version_delete ON t_p33228717_sparcom_landing_page.events;
+
+CREATE TRIGGER trg_events_version_insert
+AFTER INSERT ON t_p33228717_sparcom_landing_page.events
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE t_p33228717_sparcom_landing_page.bump_events_version();
+
+CREATE TRIGGER trg_events_version_update
+AFTER UPDATE ON t_p33228717_sparcom_landing_page.events
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE t_p33228717_sparcom_landing_page.bump_events_version();
+
+CREATE TRIGGER trg_events_version_delete
+AFTER DELETE ON t_p33228717_sparcom_landing_page.events
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE t_p33228717_sparcom_landing_page.bump_events_version();
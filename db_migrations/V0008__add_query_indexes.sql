@@ -0,0 +1,45 @@
+-- Индексы под фактические запросы функций auth, events, roles, telegram-auth, telegram-bot
+
+-- events?action=list: фильтр по статусу + keyset-пагинация по (event_date, id)
+CREATE INDEX IF NOT EXISTS idx_events_status_date_id
+ON t_p33228717_sparcom_landing_page.events(event_status, event_date, id);
+
+-- events?action=list&status=all: та же пагинация без фильтра
+CREATE INDEX IF NOT EXISTS idx_events_date_id
+ON t_p33228717_sparcom_landing_page.events(event_date, id);
+
+-- Одиночные индексы выше полностью перекрыты составными
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_events_status;
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_events_date;
+
+-- Внешние ключи events: кабинеты организаторов/мастеров и удаление бань/мастеров
+CREATE INDEX IF NOT EXISTS idx_events_organizer_date
+ON t_p33228717_sparcom_landing_page.events(organizer_id, event_date);
+
+CREATE INDEX IF NOT EXISTS idx_events_bathhouse
+ON t_p33228717_sparcom_landing_page.events(bathhouse_id) WHERE bathhouse_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_events_master
+ON t_p33228717_sparcom_landing_page.events(master_id) WHERE master_id IS NOT NULL;
+
+-- Бронирования по событию обслуживает UNIQUE(event_id, user_id)
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_bookings_event;
+
+-- roles?action=list: только заявки на рассмотрении, по дате подачи
+CREATE INDEX IF NOT EXISTS idx_role_applications_pending_created
+ON t_p33228717_sparcom_landing_page.role_applications(created_at) WHERE app_status = 'pending';
+
+-- roles?action=my и проверка существующей заявки в roles?action=apply
+CREATE INDEX IF NOT EXISTS idx_role_applications_user_created
+ON t_p33228717_sparcom_landing_page.role_applications(user_id, created_at DESC) INCLUDE (app_status);
+
+-- Поиск истёкших сессий для очистки
+CREATE INDEX IF NOT EXISTS idx_user_sessions_expires_at
+ON t_p33228717_sparcom_landing_page.user_sessions(expires_at);
+
+-- Очистка использованных токенов Telegram (used = TRUE AND created_at < ...)
+CREATE INDEX IF NOT EXISTS idx_telegram_auth_tokens_used_created
+ON t_p33228717_sparcom_landing_page.telegram_auth_tokens(created_at) WHERE used = TRUE;
+
+-- users.email уже проиндексирован ограничением UNIQUE
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_users_email;
@@ -0,0 +1,10 @@
+-- Полнотекстовый поиск по событиям: events?action=search
+ALTER TABLE t_p33228717_sparcom_landing_page.events
+ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (
+    setweight(to_tsvector('russian', COALESCE(title, '')), 'A') ||
+    setweight(to_tsvector('russian', COALESCE(description, '')), 'B')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_events_search_vector
+ON t_p33228717_sparcom_landing_page.events USING GIN (search_vector);
@@ -0,0 +1,11 @@
+-- Общие вёдра токенов для ограничения попыток входа (auth?action=login)
+-- bucket_key: 'email:<адрес>' или 'ip:<адрес>'; строка, не менявшаяся дольше периода
+-- пополнения, соответствует полному ведру и может быть удалена
+CREATE TABLE IF NOT EXISTS t_p33228717_sparcom_landing_page.login_throttle (
+    bucket_key VARCHAR(300) PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_login_throttle_updated_at
+ON t_p33228717_sparcom_landing_page.login_throttle(updated_at);
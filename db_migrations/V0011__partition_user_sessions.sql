@@ -0,0 +1,80 @@
+-- Сессии разбиты на месячные секции по expires_at: истёкший месяц удаляется целиком
+-- через DROP TABLE вместо построчного DELETE. Секции создаёт и удаляет
+-- maintain_user_sessions_partitions(), её вызывает очистка в функции auth.
+-- Уникальность на секционированной таблице должна включать ключ секционирования,
+-- поэтому токен проиндексирован без UNIQUE (токены — 256 бит случайных данных).
+
+ALTER TABLE t_p33228717_sparcom_landing_page.user_sessions RENAME TO user_sessions_unpartitioned;
+
+CREATE TABLE t_p33228717_sparcom_landing_page.user_sessions (
+    id INTEGER NOT NULL DEFAULT nextval('t_p33228717_sparcom_landing_page.user_sessions_id_seq'),
+    user_id INTEGER NOT NULL REFERENCES t_p33228717_sparcom_landing_page.users(id),
+    token VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    CONSTRAINT user_sessions_partitioned_pkey PRIMARY KEY (id, expires_at)
+) PARTITION BY RANGE (expires_at);
+
+-- Страховка на случай, если очистка долго не запускалась и нужной секции нет
+CREATE TABLE t_p33228717_sparcom_landing_page.user_sessions_default
+PARTITION OF t_p33228717_sparcom_landing_page.user_sessions DEFAULT;
+
+CREATE OR REPLACE FUNCTION t_p33228717_sparcom_landing_page.maintain_user_sessions_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE;
+    expired RECORD;
+    dropped INTEGER := 0;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := date_trunc('month', NOW()) + make_interval(months => i);
+        -- Секцию нельзя создать, пока подходящие строки лежат в секции по умолчанию;
+        -- они дождутся построчной очистки
+        IF to_regclass(format('t_p33228717_sparcom_landing_page.user_sessions_p%s', to_char(month_start, 'YYYYMM'))) IS NULL
+           AND NOT EXISTS (
+               SELECT 1 FROM t_p33228717_sparcom_landing_page.user_sessions_default
+               WHERE expires_at >= month_start AND expires_at < month_start + INTERVAL '1 month'
+           ) THEN
+            EXECUTE format(
+                'CREATE TABLE t_p33228717_sparcom_landing_page.%I PARTITION OF t_p33228717_sparcom_landing_page.user_sessions FOR VALUES FROM (%L) TO (%L)',
+                'user_sessions_p' || to_char(month_start, 'YYYYMM'),
+                month_start,
+                month_start + INTERVAL '1 month'
+            );
+        END IF;
+    END LOOP;
+
+    -- Секция user_sessions_pYYYYMM целиком истекла, когда закончился её месяц
+    FOR expired IN
+        SELECT c.relname
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = 't_p33228717_sparcom_landing_page.user_sessions'::regclass
+          AND c.relname ~ '^user_sessions_p[0-9]{6}$'
+          AND to_date(substr(c.relname, 16), 'YYYYMM') + INTERVAL '1 month' <= NOW()
+    LOOP
+        EXECUTE format('DROP TABLE t_p33228717_sparcom_landing_page.%I', expired.relname);
+        dropped := dropped + 1;
+    END LOOP;
+
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT t_p33228717_sparcom_landing_page.maintain_user_sessions_partitions(3);
+
+-- Переносим только живые сессии, истёкшие исчезают вместе со старой таблицей
+INSERT INTO t_p33228717_sparcom_landing_page.user_sessions (id, user_id, token, created_at, expires_at)
+SELECT id, user_id, token, created_at, expires_at
+FROM t_p33228717_sparcom_landing_page.user_sessions_unpartitioned
+WHERE expires_at > NOW();
+
+ALTER SEQUENCE t_p33228717_sparcom_landing_page.user_sessions_id_seq
+OWNED BY t_p33228717_sparcom_landing_page.user_sessions.id;
+
+DROP TABLE t_p33228717_sparcom_landing_page.user_sessions_unpartitioned;
+
+-- Индексы создаются на родителе и наследуются каждой секцией
+CREATE INDEX idx_user_sessions_token ON t_p33228717_sparcom_landing_page.user_sessions(token);
+CREATE INDEX idx_user_sessions_user_id ON t_p33228717_sparcom_landing_page.user_sessions(user_id);
+CREATE INDEX idx_user_sessions_expires_at ON t_p33228717_sparcom_landing_page.user_sessions(expires_at);
@@ -0,0 +1,19 @@
+-- В сессиях хранится SHA-256 токена (32 байта bytea) вместо самого токена.
+-- Покрывающий индекс отдаёт user_id и expires_at без обращения к таблице,
+-- поэтому проверка сессии выполняется как Index Only Scan.
+-- Существующие сессии продолжают работать: хеш считается из сохранённого токена.
+
+ALTER TABLE t_p33228717_sparcom_landing_page.user_sessions ADD COLUMN token_hash BYTEA;
+
+UPDATE t_p33228717_sparcom_landing_page.user_sessions
+SET token_hash = sha256(convert_to(token, 'UTF8'));
+
+ALTER TABLE t_p33228717_sparcom_landing_page.user_sessions ALTER COLUMN token_hash SET NOT NULL;
+
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_user_sessions_token;
+ALTER TABLE t_p33228717_sparcom_landing_page.user_sessions DROP COLUMN token;
+
+CREATE INDEX idx_user_sessions_token_hash
+ON t_p33228717_sparcom_landing_page.user_sessions(token_hash) INCLUDE (user_id, expires_at);
+
+ANALYZE t_p33228717_sparcom_landing_page.user_sessions;
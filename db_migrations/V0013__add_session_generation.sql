@@ -0,0 +1,22 @@
+-- Поколение сессий пользователя: «выйти везде» увеличивает users.session_generation,
+-- и все токены, выданные с прежним поколением, перестают приниматься.
+-- session_generation_changed_at позволяет функциям забирать только недавние изменения.
+
+ALTER TABLE t_p33228717_sparcom_landing_page.users
+    ADD COLUMN IF NOT EXISTS session_generation INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS session_generation_changed_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_users_session_generation_changed
+ON t_p33228717_sparcom_landing_page.users(session_generation_changed_at)
+WHERE session_generation_changed_at IS NOT NULL;
+
+ALTER TABLE t_p33228717_sparcom_landing_page.user_sessions
+    ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE t_p33228717_sparcom_landing_page.refresh_tokens
+    ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0;
+
+-- Поколение нужно проверке сессии: держим его в покрывающем индексе
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_user_sessions_token_hash;
+CREATE INDEX idx_user_sessions_token_hash
+ON t_p33228717_sparcom_landing_page.user_sessions(token_hash) INCLUDE (user_id, expires_at, generation);
@@ -0,0 +1,43 @@
+-- Момент последнего изменения данных, которые отдаёт auth?action=me: по нему функция
+-- auth сбрасывает закешированные ответы /me в своих контейнерах
+ALTER TABLE t_p33228717_sparcom_landing_page.users
+    ADD COLUMN IF NOT EXISTS profile_changed_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_users_profile_changed
+ON t_p33228717_sparcom_landing_page.users(profile_changed_at)
+WHERE profile_changed_at IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION t_p33228717_sparcom_landing_page.stamp_user_profile_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.profile_changed_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_profile_changed ON t_p33228717_sparcom_landing_page.users;
+
+CREATE TRIGGER trg_users_profile_changed
+BEFORE UPDATE OF username, email, first_name, last_name ON t_p33228717_sparcom_landing_page.users
+FOR EACH ROW
+WHEN ((OLD.username, OLD.email, OLD.first_name, OLD.last_name)
+      IS DISTINCT FROM (NEW.username, NEW.email, NEW.first_name, NEW.last_name))
+EXECUTE PROCEDURE t_p33228717_sparcom_landing_page.stamp_user_profile_changed();
+
+-- Роль, телефон, описание и верификация живут в user_profiles (их меняет, например,
+-- одобрение заявки в функции roles)
+CREATE OR REPLACE FUNCTION t_p33228717_sparcom_landing_page.touch_user_profile_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE t_p33228717_sparcom_landing_page.users
+    SET profile_changed_at = CURRENT_TIMESTAMP
+    WHERE id = NEW.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_profiles_changed ON t_p33228717_sparcom_landing_page.user_profiles;
+
+CREATE TRIGGER trg_user_profiles_changed
+AFTER INSERT OR UPDATE ON t_p33228717_sparcom_landing_page.user_profiles
+FOR EACH ROW EXECUTE PROCEDURE t_p33228717_sparcom_landing_page.touch_user_profile_changed();
@@ -0,0 +1,25 @@
+-- Обмен токена Telegram-входа делает upsert пользователя по telegram_id (ON CONFLICT),
+-- для этого нужен уникальный индекс. UNIQUE из V0006 не применился: колонку к тому
+-- моменту уже добавила V0005 без ограничения. Обычный индекс им полностью перекрыт.
+-- Дубликаты telegram_id — разные аккаунты со своими сессиями, бронированиями и
+-- событиями, автоматически их не слить: миграция останавливается и называет их.
+DO $$
+DECLARE
+    duplicates TEXT;
+BEGIN
+    SELECT string_agg(telegram_id || ' (users.id ' || ids || ')', '; ' ORDER BY telegram_id)
+    INTO duplicates
+    FROM (SELECT telegram_id, string_agg(id::text, ', ' ORDER BY id) AS ids
+          FROM t_p33228717_sparcom_landing_page.users
+          WHERE telegram_id IS NOT NULL
+          GROUP BY telegram_id
+          HAVING count(*) > 1) AS d;
+    IF duplicates IS NOT NULL THEN
+        RAISE EXCEPTION 'users.telegram_id is not unique, merge or clear these accounts before V0015: %', duplicates;
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_telegram_id_unique
+ON t_p33228717_sparcom_landing_page.users(telegram_id);
+
+DROP INDEX IF EXISTS t_p33228717_sparcom_landing_page.idx_users_telegram_id;
@@ -0,0 +1,15 @@
+-- Ротация refresh-токенов: каждый refresh выдаёт новый токен той же цепочки
+-- (family_id), а прежний помечается rotated_at. Повторное предъявление уже
+-- заменённого токена означает утечку — telegram-auth удаляет всю цепочку.
+-- Новый токен наследует expires_at цепочки, поэтому заменённые токены живут
+-- до конца цепочки и удаляются вместе с ней по истечении срока.
+CREATE SEQUENCE IF NOT EXISTS t_p33228717_sparcom_landing_page.refresh_token_family_seq;
+
+-- Существующие токены получают каждый свою цепочку
+ALTER TABLE t_p33228717_sparcom_landing_page.refresh_tokens
+    ADD COLUMN IF NOT EXISTS family_id BIGINT NOT NULL
+        DEFAULT nextval('t_p33228717_sparcom_landing_page.refresh_token_family_seq'),
+    ADD COLUMN IF NOT EXISTS rotated_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_family
+ON t_p33228717_sparcom_landing_page.refresh_tokens(family_id);
@@ -0,0 +1,5 @@
+-- Пользователи, вошедшие через Telegram, создаются без email: обмен токена в
+-- telegram-auth вставляет строку users только с telegram_id. UNIQUE на email
+-- сохраняется, NULL ему не мешает.
+ALTER TABLE t_p33228717_sparcom_landing_page.users
+    ALTER COLUMN email DROP NOT NULL;
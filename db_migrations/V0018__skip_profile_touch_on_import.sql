@@ -0,0 +1,15 @@
+-- Массовый импорт (scripts/import_users.py) сам проставляет users.profile_changed_at
+-- и включает sparcom.skip_profile_touch на время своей транзакции: иначе каждая
+-- вставка в user_profiles давала бы отдельный UPDATE users
+CREATE OR REPLACE FUNCTION t_p33228717_sparcom_landing_page.touch_user_profile_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('sparcom.skip_profile_touch', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    UPDATE t_p33228717_sparcom_landing_page.users
+    SET profile_changed_at = CURRENT_TIMESTAMP
+    WHERE id = NEW.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,311 @@
+"""
+Массовый импорт пользователей из старой системы бронирования.
+
+Запуск (файл читается потоком, целиком в памяти не держится):
+
+    DATABASE_URL=postgres://... python scripts/import_users.py users.csv --report conflicts.csv
+    zcat users.ndjson.gz | DATABASE_URL=postgres://... python scripts/import_users.py - --format ndjson
+
+Поля записи: username, email, password или password_hash (уже посчитанный хеш в
+формате функции auth), first_name, last_name, role, phone. Открытые пароли хешируются
+той же hash_password, что и в auth?action=register, в пуле процессов на все ядра.
+
+Все строки потоком уходят через COPY во временную таблицу, затем одним выражением
+переносятся в users и user_profiles. Занятые в базе и повторяющиеся внутри файла email
+и username не импортируются и попадают в отчёт (номер строки, email, username,
+причина) вместе с некорректными записями. Импорт идёт одной транзакцией;
+с --dry-run она откатывается.
+"""
+
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import psycopg2
+
+AUTH_INDEX = Path(__file__).resolve().parent.parent / 'backend' / 'auth' / 'index.py'
+
+ROLES = {'participant', 'organizer', 'master', 'bathowner'}
+COLUMNS = ('line_no', 'username', 'email', 'password_hash', 'first_name', 'last_name', 'user_role', 'phone')
+LIMITS = {'username': 150, 'email': 254, 'password_hash': 255, 'first_name': 150, 'last_name': 150, 'phone': 20}
+# Хеш до версионирования: hex 32 символов соли и 32 байт PBKDF2-SHA256
+LEGACY_HASH_LENGTH = 128
+
+STAGING_SQL = """
+CREATE TEMP TABLE import_users_staging (
+    line_no BIGINT NOT NULL,
+    username VARCHAR(150) NOT NULL,
+    email VARCHAR(254) NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    first_name VARCHAR(150) NOT NULL,
+    last_name VARCHAR(150) NOT NULL,
+    user_role VARCHAR(50) NOT NULL,
+    phone VARCHAR(20) NOT NULL
+) ON COMMIT DROP
+"""
+
+# Первая по номеру строки запись с данным email/username — кандидат, остальные — дубли
+CLASSIFY_SQL = """
+CREATE TEMP TABLE import_users_classified ON COMMIT DROP AS
+WITH ranked AS (
+    SELECT s.*,
+           row_number() OVER (PARTITION BY email ORDER BY line_no) AS email_rank,
+           row_number() OVER (PARTITION BY username ORDER BY line_no) AS username_rank
+    FROM import_users_staging s
+)
+SELECT r.line_no, r.username, r.email, r.password_hash, r.first_name, r.last_name, r.user_role, r.phone,
+       CASE
+           WHEN EXISTS (SELECT 1 FROM users u WHERE u.email = r.email) THEN 'email_taken'
+           WHEN EXISTS (SELECT 1 FROM users u WHERE u.username = r.username) THEN 'username_taken'
+           WHEN r.email_rank > 1 THEN 'duplicate_email'
+           WHEN r.username_rank > 1 THEN 'duplicate_username'
+       END AS conflict
+FROM ranked r
+"""
+
+# Строки, которые заняла параллельная регистрация уже после классификации,
+# отсекает ON CONFLICT, а в отчёт они попадают как taken_concurrently.
+# profile_changed_at ставится сразу: триггер user_profiles на время импорта
+# выключен (sparcom.skip_profile_touch), чтобы не давать UPDATE users на строку
+MERGE_SQL = """
+WITH new_users AS (
+    INSERT INTO users (username, email, password_hash, first_name, last_name, profile_changed_at)
+    SELECT username, email, password_hash, first_name, last_name, CURRENT_TIMESTAMP
+    FROM import_users_classified
+    WHERE conflict IS NULL
+    ORDER BY line_no
+    ON CONFLICT DO NOTHING
+    RETURNING id, email
+), profiles AS (
+    INSERT INTO user_profiles (user_id, user_role, phone)
+    SELECT n.id, c.user_role, c.phone
+    FROM new_users n
+    JOIN import_users_classified c ON c.email = n.email AND c.conflict IS NULL
+    RETURNING user_id
+), lost AS (
+    UPDATE import_users_classified c
+    SET conflict = 'taken_concurrently'
+    WHERE c.conflict IS NULL AND NOT EXISTS (SELECT 1 FROM new_users n WHERE n.email = c.email)
+)
+SELECT COUNT(*) FROM profiles
+"""
+
+_auth = None
+
+
+def load_auth_module():
+    spec = importlib.util.spec_from_file_location('auth_index', AUTH_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def init_worker():
+    global _auth
+    _auth = load_auth_module()
+
+
+def hash_passwords(passwords: list) -> list:
+    return [_auth.hash_password(password) for password in passwords]
+
+
+def read_records(stream, fmt: str):
+    """(номер строки, запись) по одной, без чтения файла целиком"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            yield line_no, record if isinstance(record, dict) else None
+
+
+def normalize(auth, record) -> tuple:
+    """(строка для staging без хеша, открытый пароль или None) либо (None, причина)"""
+    if record is None:
+        return None, 'unparsable'
+
+    row = {
+        'username': str(record.get('username') or '').strip(),
+        'email': str(record.get('email') or '').strip().lower(),
+        'password_hash': str(record.get('password_hash') or '').strip(),
+        'first_name': str(record.get('first_name') or '').strip(),
+        'last_name': str(record.get('last_name') or '').strip(),
+        'user_role': str(record.get('role') or 'participant').strip(),
+        'phone': str(record.get('phone') or '').strip(),
+    }
+    password = str(record.get('password') or '')
+
+    if not row['username'] or not row['email']:
+        return None, 'missing_username_or_email'
+    if any(len(row[name]) > limit for name, limit in LIMITS.items()):
+        return None, 'too_long'
+    if row['user_role'] not in ROLES:
+        return None, 'unknown_role'
+    if row['password_hash']:
+        # Тот же разбор, что и при входе: хеш, который он не примет, не импортируется
+        legacy = not row['password_hash'].startswith('$')
+        try:
+            auth.parse_password_hash(row['password_hash'])
+        except ValueError:
+            return None, 'unsupported_password_hash'
+        if legacy and len(row['password_hash']) != LEGACY_HASH_LENGTH:
+            return None, 'unsupported_password_hash'
+        return row, None
+    if not password:
+        return None, 'missing_password'
+    return row, password
+
+
+def hashed_rows(pending, executor, workers: int):
+    """Строки staging с готовыми хешами в исходном порядке.
+
+    В пуле не больше 2 * workers пачек: чтение файла ждёт хеширования.
+    """
+    in_flight = deque()
+
+    def drain(limit: int):
+        while len(in_flight) > limit:
+            batch, future = in_flight.popleft()
+            hashes = iter(future.result()) if future else iter(())
+            for row, password in batch:
+                if password is not None:
+                    row['password_hash'] = next(hashes)
+                yield row
+
+    for batch in pending:
+        passwords = [password for _, password in batch if password is not None]
+        future = executor.submit(hash_passwords, passwords) if passwords else None
+        in_flight.append((batch, future))
+        yield from drain(2 * workers)
+    yield from drain(0)
+
+
+class CopyStream:
+    """Файлоподобный источник для COPY: CSV формируется по мере чтения"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, quoting=csv.QUOTE_ALL)
+        self.pending = ''
+        self.count = 0
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.pending) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow([row[column] for column in COLUMNS])
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.count += 1
+        if size < 0:
+            size = len(self.pending)
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help="CSV или NDJSON файл, '-' — stdin")
+    parser.add_argument('--format', choices=('csv', 'ndjson'))
+    parser.add_argument('--report', help='куда писать отклонённые строки (CSV), по умолчанию stderr')
+    parser.add_argument('--schema', default='t_p33228717_sparcom_landing_page')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=500, help='записей в одной пачке хеширования')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    fmt = args.format or ('ndjson' if args.source.endswith(('.ndjson', '.jsonl')) else 'csv')
+    stream = sys.stdin if args.source == '-' else open(args.source, encoding='utf-8', newline='')
+    report_file = open(args.report, 'w', encoding='utf-8', newline='') if args.report else sys.stderr
+    report = csv.writer(report_file)
+    report.writerow(['line', 'email', 'username', 'reason'])
+
+    auth = load_auth_module()
+    reasons = Counter()
+
+    def batches():
+        batch = []
+        for line_no, record in read_records(stream, fmt):
+            row, password = normalize(auth, record)
+            if row is None:
+                reasons[password] += 1
+                report.writerow([line_no, (record or {}).get('email', ''), (record or {}).get('username', ''), password])
+                continue
+            row['line_no'] = line_no
+            batch.append((row, password))
+            if len(batch) >= args.batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    started = time.perf_counter()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        with conn.cursor() as cur, ProcessPoolExecutor(args.workers, initializer=init_worker) as executor:
+            cur.execute(f'SET LOCAL search_path TO {args.schema}')
+            cur.execute(STAGING_SQL)
+            source = CopyStream(hashed_rows(batches(), executor, args.workers))
+            cur.copy_expert(
+                f"COPY import_users_staging ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                source
+            )
+            loaded_at = time.perf_counter()
+
+            cur.execute(CLASSIFY_SQL)
+            cur.execute("SET LOCAL sparcom.skip_profile_touch = 'on'")
+            cur.execute(MERGE_SQL)
+            imported = cur.fetchone()[0]
+
+        # Отчёт о конфликтах читается курсором на сервере, по частям
+        with conn.cursor(name='import_conflicts') as cur:
+            cur.itersize = 5000
+            cur.execute(
+                """SELECT line_no, email, username, conflict FROM import_users_classified
+                   WHERE conflict IS NOT NULL ORDER BY line_no"""
+            )
+            for line_no, email, username, conflict in cur:
+                reasons[conflict] += 1
+                report.writerow([line_no, email, username, conflict])
+
+        if args.dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        if args.report:
+            report_file.close()
+
+    elapsed = time.perf_counter() - started
+    print(f'staged           {source.count}')
+    print(f'imported         {imported}{" (dry run, rolled back)" if args.dry_run else ""}')
+    print(f'rejected         {dict(sorted(reasons.items()))}')
+    print(f'load + hash      {loaded_at - started:.1f} s ({source.count / (loaded_at - started):.0f} rows/s)')
+    print(f'total            {elapsed:.1f} s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
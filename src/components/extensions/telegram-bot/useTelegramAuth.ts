@@ -69,6 +69,19 @@ function clearStoredRefreshToken(): void {
   localStorage.removeItem(REFRESH_TOKEN_KEY);
 }
 
+/**
+ * Another tab sharing localStorage rotated the refresh token first (server
+ * answered 409): wait for that tab to store the successor.
+ */
+async function waitForRotatedRefreshToken(previous: string): Promise<string | null> {
+  for (let waited = 0; waited < 5000; waited += 250) {
+    const current = getStoredRefreshToken();
+    if (current !== previous) return current;
+    await new Promise((resolve) => setTimeout(resolve, 250));
+  }
+  return null;
+}
+
 // =============================================================================
 // HOOK
 // =============================================================================
@@ -108,39 +121,51 @@ export function useTelegramAuth(options: UseTelegramAuthOptions): UseTelegramAut
 
       const refreshIn = Math.max((expiresInSeconds - refreshBeforeExpiry) * 1000, 1000);
 
-      refreshTimerRef.current = setTimeout(async () => {
-        const success = await refreshFn();
-        if (!success) {
-          clearAuth();
-        }
-      }, refreshIn);
+      // refreshFn clears auth itself when the session is really gone
+      refreshTimerRef.current = setTimeout(refreshFn, refreshIn);
     },
-    [autoRefresh, refreshBeforeExpiry, clearAuth]
+    [autoRefresh, refreshBeforeExpiry]
   );
 
   const refreshTokenFn = useCallback(async (): Promise<boolean> => {
-    const storedRefreshToken = getStoredRefreshToken();
-    if (!storedRefreshToken) {
-      return false;
-    }
+    let storedRefreshToken = getStoredRefreshToken();
 
     try {
-      const response = await fetch(apiUrls.refresh, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ refresh_token: storedRefreshToken }),
-      });
+      // Retries only follow a rotation done by another tab
+      for (let attempt = 0; storedRefreshToken && attempt < 3; attempt++) {
+        const response = await fetch(apiUrls.refresh, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ refresh_token: storedRefreshToken }),
+        });
+
+        if (response.status === 409) {
+          // Clearing the shared storage here would log the other tab out too
+          storedRefreshToken = await waitForRotatedRefreshToken(storedRefreshToken);
+          continue;
+        }
 
-      if (!response.ok) {
-        clearAuth();
-        return false;
+        if (!response.ok) {
+          const current = getStoredRefreshToken();
+          if (current && current !== storedRefreshToken) {
+            storedRefreshToken = current;
+            continue;
+          }
+          clearAuth();
+          return false;
+        }
+
+        const data = await response.json();
+        setAccessToken(data.access_token);
+        setUser(data.user);
+        setStoredRefreshToken(data.refresh_token);
+        scheduleRefresh(data.expires_in, refreshTokenFn);
+        return true;
       }
 
-      const data = await response.json();
-      setAccessToken(data.access_token);
-      setUser(data.user);
-      scheduleRefresh(data.expires_in, refreshTokenFn);
-      return true;
+      setAccessToken(null);
+      setUser(null);
+      return false;
     } catch {
       clearAuth();
       return false;